@@ -18,11 +18,18 @@ import time
 
 import click
 import boto3
-import alive_progress as alive
 from simple_term_menu import TerminalMenu
 
 import logger
-from utils import AdbException
+import progress
+import rootfs
+import tasks
+import chunks
+import inventory
+import package
+import bundle
+import stream
+from utils import AdbException, get_serial, serial_args
 
 VERSION = "v0.1.0"
 
@@ -53,10 +60,9 @@ LOCAL_SETUP_DIR = f"{SCRIPT_DIR}/setup"
 SSH_SETUP = "ssh_setup"
 ADB_SETUP = "adb_keys"
 
-if AWS_ACCESS_KEY_ID == None or AWS_SECRET_ACCESS_KEY == None or AWS_S3_REGION_NAME == None:
-    logger.error("Missing aws configuration. Check your env variables for AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_S3_REGION_NAME")
-    sys.exit(1)
 s3 = None
+# set by station, whose device threads all use its s3 client. It closes the client itself.
+shared_s3 = False
 
 MAGISK = "magisk"
 ANX = "anx"
@@ -69,12 +75,20 @@ LINUX_DEPLOY=f"{ANX_APP_ROOT_FOLDER_PATH}/bin/linuxdeploy"
 
 # variables for file system
 PATH_TO_CONFIG_FILES=f"{ANX_APP_ROOT_FOLDER_PATH}/config/"
+REMOTE_ROOTFS_TARBALL="/sdcard/flo-linux-rootfs.tar.gz"
+# clean copy of a linux.img built on the host, restored by bootup.sh on recovery
+REMOTE_ROOTFS_IMAGE="/sdcard/flo-linux-rootfs.img"
+LOCAL_IMAGES_DIR=f"{LOCAL_SETUP_DIR}/images"
 
 def download_file(url, filename):
-    with alive.alive_bar() as bar:
-        def progress(count, block_size, total_size):
-            bar()
-        request.urlretrieve(url, filename, progress)
+    with progress.track(filename) as transfer:
+        def report(count, block_size, total_size):
+            if total_size > 0:
+                transfer.total = total_size
+                transfer.set(min(count * block_size, total_size))
+            else:
+                transfer.set(count * block_size)
+        request.urlretrieve(url, filename, report)
 
 
 def unzip_platform_tools():
@@ -88,6 +102,9 @@ def unzip_platform_tools():
 
 
 def check_platform_tools():
+    if not os.path.exists('platform-tools') and bundle.current is not None:
+        if bundle.current.extract_platform_tools(PLATFORM):
+            return
     logger.info('Downloading platform tools...')
     if not os.path.exists('platform-tools'):
         download_file(PLATFORM_TOOLS_URL, 'platform-tools.zip')
@@ -97,7 +114,7 @@ def check_platform_tools():
 
 def adb_shell(cmd, *args):
     try:
-        ret = subprocess.run([ADB, "shell", cmd] + list(args), stderr=subprocess.PIPE)
+        ret = subprocess.run([ADB] + serial_args() + ["shell", cmd] + list(args), stderr=subprocess.PIPE)
         if ret.returncode == 0:
             return True
         else:
@@ -109,7 +126,7 @@ def adb_shell(cmd, *args):
 
 def adb(cmd, *args):
     try:
-        ret = subprocess.run([ADB, cmd] + list(args), stderr=subprocess.PIPE)
+        ret = subprocess.run([ADB] + serial_args() + [cmd] + list(args), stderr=subprocess.PIPE)
         if ret.returncode == 0:
             return True
         else:
@@ -119,6 +136,37 @@ def adb(cmd, *args):
         logger.error(f"Exiting with code - {e.error_code}")
         exit(e.error_code)
 
+def bundled(file_name):
+    """Name of a file of LOCAL_SETUP_DIR in the --bundle, None when it has to be downloaded"""
+    if bundle.current is None or os.path.dirname(os.path.abspath(file_name)) != os.path.abspath(LOCAL_SETUP_DIR):
+        return None
+    return bundle.current.setup_entry(file_name)
+
+def offline_copy(file_name):
+    """True when a --bundle is used and file_name is on this PC instead
+
+    There is no S3 with a bundle, so a file in neither place is an error.
+    """
+    if bundle.current is None:
+        return False
+    if not os.path.isfile(file_name):
+        logger.error(f"{os.path.basename(file_name)} is not in {bundle.current.file_name}")
+        sys.exit(1)
+    return True
+
+def install_apk(file_name):
+    if bundled(file_name):
+        bundle.current.install([ADB] + serial_args(), bundled(file_name))
+    else:
+        adb("install", file_name)
+
+def push_setup_file(file_name, remote_path):
+    """Pushes a setup file, streaming it from the --bundle when it is bundled"""
+    if bundled(file_name):
+        bundle.current.push([ADB] + serial_args(), bundled(file_name), remote_path)
+    else:
+        adb("push", file_name, remote_path)
+
 def check_aws_credentials():
     if AWS_ACCESS_KEY_ID == None or AWS_SECRET_ACCESS_KEY == None or AWS_S3_REGION_NAME == None:
         logger.error(
@@ -129,9 +177,10 @@ def download_magisk_apk():
     file_name = f"{MAGISK}.apk"
     logger.info("Downloading Magisk ...")
     local_magisk = f"{LOCAL_SETUP_DIR}/{file_name}"
-    if os.path.isfile(local_magisk):
+    if os.path.isfile(local_magisk) or bundled(local_magisk):
         logger.info("Using cache.")
         return
+    offline_copy(local_magisk)
     s3.download_file(
         Bucket=FLO_OS_SETUP_BUCKET_NAME,
         Key=file_name,
@@ -141,16 +190,17 @@ def download_magisk_apk():
 def install_magisk():
     logger.info("Installing Magisk ...")
     file_name = f"{MAGISK}.apk"
-    adb("install", f"{LOCAL_SETUP_DIR}/{file_name}")
+    install_apk(f"{LOCAL_SETUP_DIR}/{file_name}")
     logger.info("Done.")
 
 def download_anx_apk():
     file_name = f"{ANX}.apk"
     logger.info("Downloading anx ...")
     local_anx = f"{LOCAL_SETUP_DIR}/{file_name}"
-    if os.path.isfile(local_anx):
+    if os.path.isfile(local_anx) or bundled(local_anx):
         logger.info("Using cache.")
         return
+    offline_copy(local_anx)
     s3.download_file(
         Bucket=FLO_OS_SETUP_BUCKET_NAME,
         Key=file_name,
@@ -160,18 +210,24 @@ def download_anx_apk():
 def install_anx():
     logger.info("Installing anx app  ...")
     file_name = f"{ANX}.apk"
-    adb("install", f"{LOCAL_SETUP_DIR}/{file_name}")
+    install_apk(f"{LOCAL_SETUP_DIR}/{file_name}")
     logger.info("Done.")
 
 def populate_and_select_file_systems():
-    s3.download_file(
-        Bucket=FLO_OS_SETUP_BUCKET_NAME,
-        Key="manifest",
-        Filename=f"{LOCAL_SETUP_DIR}/manifest")
-    
-    with open(f'{LOCAL_SETUP_DIR}/manifest') as f:
-        versions = f.read()
-        versions = versions.rstrip().split("\n")
+    if bundle.current is not None:
+        versions = bundle.current.file_systems()
+        if not versions:
+            logger.error(f"No file systems in {bundle.current.file_name}")
+            sys.exit(1)
+    else:
+        s3.download_file(
+            Bucket=FLO_OS_SETUP_BUCKET_NAME,
+            Key="manifest",
+            Filename=f"{LOCAL_SETUP_DIR}/manifest")
+
+        with open(f'{LOCAL_SETUP_DIR}/manifest') as f:
+            versions = f.read()
+            versions = versions.rstrip().split("\n")
     terminal_menu = TerminalMenu(
         menu_entries=versions,
         title="--- Available file systems ---", 
@@ -182,6 +238,12 @@ def populate_and_select_file_systems():
 def download_ssh_setup():
     logger.info(f"Downloading ssh setup files ...")
     file_name = f"{SSH_SETUP}.zip"
+    if bundled(f"{LOCAL_SETUP_DIR}/{file_name}"):
+        logger.info("Using bundle.")
+        return
+    if offline_copy(f"{LOCAL_SETUP_DIR}/{file_name}"):
+        logger.info("Using cache.")
+        return
     s3.download_file(
         Bucket=FLO_OS_SETUP_BUCKET_NAME,
         Key=file_name,
@@ -191,6 +253,12 @@ def download_ssh_setup():
 def download_adb_setup():
     logger.info(f"Downloading adb setup files ...")
     file_name = f"{ADB_SETUP}.zip"
+    if bundled(f"{LOCAL_SETUP_DIR}/{file_name}"):
+        logger.info("Using bundle.")
+        return
+    if offline_copy(f"{LOCAL_SETUP_DIR}/{file_name}"):
+        logger.info("Using cache.")
+        return
     s3.download_file(
         Bucket=FLO_OS_SETUP_BUCKET_NAME,
         Key=file_name,
@@ -200,6 +268,12 @@ def download_adb_setup():
 def download_fs_config(file_system_name):
     logger.info(f"Downloading {file_system_name} config ...")
     file_name = f"{file_system_name}.conf"
+    if bundled(f"{LOCAL_SETUP_DIR}/{file_name}"):
+        logger.info("Using bundle.")
+        return
+    if offline_copy(f"{LOCAL_SETUP_DIR}/{file_name}"):
+        logger.info("Using cache.")
+        return
     s3.download_file(
         Bucket=FLO_OS_SETUP_BUCKET_NAME,
         Key=file_name,
@@ -209,7 +283,13 @@ def download_fs_config(file_system_name):
 def download_file_system(file_system_name):
     file_system_name = f"{file_system_name}-rootfs.tar.gz"
     file_name = f"{LOCAL_SETUP_DIR}/{file_system_name}"
-    setup_file = s3.get_object(
+    if bundled(file_name):
+        logger.info(f"Using {file_system_name} from bundle.")
+        return
+    if offline_copy(file_name):
+        logger.info('FS already downloaded, using cache.')
+        return
+    setup_file = s3.head_object(
         Bucket=FLO_OS_SETUP_BUCKET_NAME,
         Key=file_system_name
     )
@@ -218,46 +298,110 @@ def download_file_system(file_system_name):
     if os.path.isfile(file_name):
         logger.info('FS already downloaded, using cache.')
         return
-    
-    with alive.alive_bar(manual=True) as bar:
-        global bytes_seen
-        bytes_seen = 0
 
-        def progress(bytes):
-            # logger.info(f"Downloaded {bytes} bytes so far")
-            global bytes_seen
-            bytes_seen = bytes_seen + bytes
-            percent = (bytes_seen / total_size)
-            bar(percent)
+    if chunks.delta_download(s3, FLO_OS_SETUP_BUCKET_NAME, file_system_name, file_name,
+                             LOCAL_SETUP_DIR, ["*-rootfs.tar.gz"]):
+        logger.info('Done.')
+        return
 
+    # boto3 reports progress from several threads, Transfer.update is thread-safe.
+    # Raising from the callback stops the download when the other steps failed.
+    with progress.track(file_system_name, total_size) as transfer:
         s3.download_file(
             Bucket=FLO_OS_SETUP_BUCKET_NAME,
             Key=file_system_name,
             Filename=file_name,
-            Callback=progress)
+            Callback=tasks.cancellable(transfer.update))
     logger.info('Done.')
 
+def stream_file_system(file_system_name, tee):
+    """Streams a file system from S3 to the device, without a copy on the host unless tee"""
+    key = f"{file_system_name}-rootfs.tar.gz"
+    logger.info(f"Streaming {key} to the device ...")
+    stream.push_object([ADB] + serial_args(), s3, FLO_OS_SETUP_BUCKET_NAME, key, REMOTE_ROOTFS_TARBALL,
+                       tee=f"{LOCAL_SETUP_DIR}/{key}" if tee else None)
+    logger.info("Done.")
+
 def push_config_file(file_name):
     adb_shell(f"mkdir -p {PATH_TO_CONFIG_FILES}")
     logger.info("Uploading config file ...")
-    adb("push", file_name, f"{PATH_TO_CONFIG_FILES}/linux.conf")
+    push_setup_file(file_name, f"{PATH_TO_CONFIG_FILES}/linux.conf")
     adb_shell(f"chown -R {get_owner_group()} {ANX_APP_ROOT_FOLDER_PATH}")
     logger.info("Done.")
 
 def push_file_system(file_name):
     logger.info("Uploading file system ...")
-    adb("push", file_name, "/sdcard/flo-linux-rootfs.tar.gz")
+    if bundled(file_name):
+        push_setup_file(file_name, REMOTE_ROOTFS_TARBALL)
+        logger.info("Done.")
+        return
+    # streamed rather than adb push, so the meter follows the bytes as they go
+    cancel = tasks.cancel_event()
+    proc = subprocess.Popen([ADB] + serial_args() + ["exec-in", f"cat > {REMOTE_ROOTFS_TARBALL}"],
+                            stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with open(file_name, "rb") as f, \
+                progress.track("Uploading file system", os.path.getsize(file_name)) as transfer:
+            for data in iter(lambda: f.read(rootfs.PUSH_CHUNK_SIZE), b""):
+                if cancel.is_set():
+                    raise tasks.Cancelled()
+                proc.stdin.write(data)
+                transfer.update(len(data))
+    except BrokenPipeError:
+        # adb went away, its exit code and error are reported below
+        pass
+    except BaseException:
+        # recovery would deploy a partial tarball
+        proc.stdin.close()
+        proc.wait()
+        subprocess.run([ADB] + serial_args() + ["shell", f"rm -f {REMOTE_ROOTFS_TARBALL}"])
+        raise
+    finally:
+        proc.stdin.close()
+    error = proc.stderr.read().decode().rstrip()
+    if proc.wait() != 0:
+        logger.error(f"Error in uploading {file_name} : {error}")
+        exit(proc.returncode)
     logger.info("Done.")
 
+def build_rootfs_image(file_system_name, file_name, config_file):
+    logger.info("Building rootfs image on host ...")
+    # tar and mke2fs need files, copied out of the bundle in the kernel
+    for setup_file in (file_name, config_file):
+        if bundled(setup_file) and not os.path.isfile(setup_file):
+            bundle.current.extract(bundled(setup_file), setup_file)
+    rootfs.build_image(file_name, config_file, f"{LOCAL_IMAGES_DIR}/{file_system_name}.img")
+
+def upload_rootfs_image(file_system_name, config_file):
+    adb_shell(LINUX_DEPLOY, "umount")
+    time.sleep(2)
+    # recovery deploys a tarball when there is one, it would replace the image
+    adb_shell("rm", "-f", REMOTE_ROOTFS_TARBALL)
+    logger.info("Uploading rootfs image ...")
+    image = f"{LOCAL_IMAGES_DIR}/{file_system_name}.img"
+    target = rootfs.target_path(rootfs.read_config(config_file))
+    extents = rootfs.push_sparse([ADB] + serial_args(), image, target)
+    logger.info("Keeping a copy for recovery ...")
+    if rootfs.save_clean_copy([ADB] + serial_args(), target, REMOTE_ROOTFS_IMAGE, os.path.getsize(image), extents):
+        logger.info("Done.")
+    adb_shell(LINUX_DEPLOY, "mount")
+
+def push_rootfs_image(file_system_name, file_name, config_file):
+    """Builds linux.img on the host and uploads it, so the device only mounts it"""
+    build_rootfs_image(file_system_name, file_name, config_file)
+    upload_rootfs_image(file_system_name, config_file)
+
 def setup_chroot_env():
     logger.info("Setting up chroot env ...")
     adb_shell(LINUX_DEPLOY, "umount")
     time.sleep(2)
+    # recovery deploys the tarball from now on, a copy of an earlier host image is stale
+    adb_shell("rm", "-f", REMOTE_ROOTFS_IMAGE, f"{REMOTE_ROOTFS_IMAGE}{rootfs.EXTENTS_SUFFIX}")
     adb_shell(LINUX_DEPLOY, "deploy")
     logger.info("Done.")
 
 def do_ssh_setup():
-    adb("push", f"{LOCAL_SETUP_DIR}/{SSH_SETUP}.zip", "/")
+    push_setup_file(f"{LOCAL_SETUP_DIR}/{SSH_SETUP}.zip", f"/{SSH_SETUP}.zip")
     adb_shell("unzip", f"{SSH_SETUP}.zip")
     adb_shell("rm", f"{SSH_SETUP}.zip")
 
@@ -274,7 +418,7 @@ def do_ssh_setup():
 
 def do_adb_setup():
     logger.info("Uploading adb keys to device ...")
-    adb("push", f"{LOCAL_SETUP_DIR}/{ADB_SETUP}.zip", "/")
+    push_setup_file(f"{LOCAL_SETUP_DIR}/{ADB_SETUP}.zip", f"/{ADB_SETUP}.zip")
     adb_shell("unzip", f"{ADB_SETUP}.zip")
     adb_shell("rm", f"{ADB_SETUP}.zip")
 
@@ -282,11 +426,11 @@ def do_adb_setup():
     logger.info("Done.")
 
 def get_owner_group():
-    ret = subprocess.run([ADB, "shell", f"ls -dl {ANX_APP_FOLDER_PATH}"+"| awk '{print $3}'"], capture_output=True)
+    ret = subprocess.run([ADB] + serial_args() + ["shell", f"ls -dl {ANX_APP_FOLDER_PATH}"+"| awk '{print $3}'"], capture_output=True)
     owner = ret.stdout.decode().rstrip()
     return owner
 
-def create_boot_up_script(ssh_setup):
+def write_boot_up_scripts():
     # create bootup.sh
     with open(f"{LOCAL_SETUP_DIR}/flo_edge_bootup.rc", "w") as script:
         script.write('service flo_edge_bootup /system/bin/bootup.sh\n')
@@ -301,6 +445,10 @@ def create_boot_up_script(ssh_setup):
         with open(f"{STUB_SCRIPTS_DIR}/bootup.sh.script", "r") as script_stub:
             script_text = script_stub.read()
             script_text = script_text.replace("{LINUX_DEPLOY}", LINUX_DEPLOY)
+            script_text = script_text.replace("{ROOTFS_TARBALL}", REMOTE_ROOTFS_TARBALL)
+            script_text = script_text.replace("{ROOTFS_IMAGE}", REMOTE_ROOTFS_IMAGE)
+            script_text = script_text.replace("{ROOTFS_IMAGE_EXTENTS}", f"{REMOTE_ROOTFS_IMAGE}{rootfs.EXTENTS_SUFFIX}")
+            script_text = script_text.replace("{BLOCK_SIZE}", str(rootfs.BLOCK_SIZE))
             script.write(script_text)
     
     with open(f"{LOCAL_SETUP_DIR}/server.sh", "w") as script:
@@ -309,6 +457,7 @@ def create_boot_up_script(ssh_setup):
             script_text = script_stub.read()
             script.write(script_text)
 
+def push_boot_up_scripts():
     adb("push", f"{LOCAL_SETUP_DIR}/flo_edge_bootup.rc", "/etc/init")
     adb("push", f"{LOCAL_SETUP_DIR}/bootup.sh", "/bin/")
     adb("push", f"{LOCAL_SETUP_DIR}/server.sh", "/bin/")
@@ -318,9 +467,9 @@ def create_boot_up_script(ssh_setup):
     adb_shell("chown 0.0 /bin/bootup.sh")
     adb_shell("chmod 755 /bin/server.sh")
     adb_shell("chown 0.0 /bin/server.sh")
-    
+
 def rm_su_if_present():
-    ret = subprocess.run([ADB, "shell", "test -f /system/xbin/su"], capture_output=True)
+    ret = subprocess.run([ADB] + serial_args() + ["shell", "test -f /system/xbin/su"], capture_output=True)
         
     if ret.returncode !=0:
         logger.info("Found /system/xbin/su. Proceeding to delete...")
@@ -332,26 +481,41 @@ def cleanup():
         shutil.rmtree(LOCAL_SETUP_DIR)
 
 def exit(return_code):
-    s3.close()
+    if s3 is not None and not shared_s3:
+        s3.close()
     sys.exit(return_code)
 
-def pre_setup():
+def create_s3_client():
+    global s3
+    if bundle.current is None and not shared_s3:
+        check_aws_credentials()
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            region_name=AWS_S3_REGION_NAME)
 
-    check_aws_credentials()
+    if not os.path.exists(LOCAL_SETUP_DIR):
+        os.mkdir(LOCAL_SETUP_DIR)
 
-    global s3
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_S3_REGION_NAME)
+def prepare_host():
+    create_s3_client()
 
     # Download platform tools
     check_platform_tools()
 
-    if not os.path.exists(LOCAL_SETUP_DIR):
-        os.mkdir(LOCAL_SETUP_DIR)
+    # Download magisk and anx app
+    download_magisk_apk()
+    download_anx_apk()
 
+def grant_permissions():
+    # ensure app has storage permission granted
+    adb_shell(f"pm grant {APP_PACKAGE_NAME} android.permission.WRITE_EXTERNAL_STORAGE")
+
+    # disable lock screen
+    adb_shell("locksettings set-disabled true")
+
+def prepare_device():
     # os.chdir(LOCAL_SETUP_DIR)
     # set adb to root
     adb("root")
@@ -359,25 +523,196 @@ def pre_setup():
     # remount : equivalent to mount -o rw,remount /
     adb("remount")
 
-    # Download and install magisk
-    download_magisk_apk()
+    # Install magisk
     install_magisk()
 
-    # Download and install anx app
-    download_anx_apk()
+    # Install anx app
     install_anx()
 
-    # ensure app has storage permission granted
-    adb_shell(f"pm grant {APP_PACKAGE_NAME} android.permission.WRITE_EXTERNAL_STORAGE")
+    grant_permissions()
+
+def pre_setup_tasks():
+    """Steps of pre_setup(). Downloads start right away, device steps run in order."""
+    return [
+        tasks.Task("platform_tools", check_platform_tools),
+        tasks.Task("download_magisk", download_magisk_apk),
+        tasks.Task("download_anx", download_anx_apk),
+        # set adb to root
+        tasks.Task("adb_root", adb, ["platform_tools"], "root"),
+        # remount : equivalent to mount -o rw,remount /
+        tasks.Task("remount", adb, ["adb_root"], "remount"),
+        tasks.Task("install_magisk", install_magisk, ["remount", "download_magisk"]),
+        tasks.Task("install_anx", install_anx, ["install_magisk", "download_anx"]),
+        tasks.Task("grant_permissions", grant_permissions, ["install_anx"]),
+    ]
 
-    # disable lock screen
-    adb_shell("locksettings set-disabled true")
+def pre_setup():
+    create_s3_client()
+    tasks.run(pre_setup_tasks())
+
+def download_setup_files(file_system_name, setup_ssh, secure_adb):
+    """Downloads everything setup_device() needs for the given options"""
+    if file_system_name:
+        download_fs_config(file_system_name)
+        download_file_system(file_system_name)
+
+    if setup_ssh:
+        download_ssh_setup()
+
+    if secure_adb:
+        download_adb_setup()
+
+def start_anx_app(config_file):
+    push_config_file(config_file)
+    adb_shell(f"am start -n {APP_PACKAGE_NAME}/{APP_NAME}.activity.MainActivity")
+
+def update_inventory(file_system_name):
+    """Records the device's facts and the deployed file system in the device inventory"""
+    serial = get_serial()
+    if not serial:
+        ret = subprocess.run([ADB, "get-serialno"], capture_output=True)
+        serial = ret.stdout.decode().strip()
+    if not serial or serial == "unknown":
+        return
+    try:
+        inventory.safe_update(serial, **inventory.probe_device(serial, ADB))
+    except subprocess.TimeoutExpired:
+        logger.warn("Probing the device for the inventory timed out.")
+    inventory.record_bootstrap(serial, file_system_name)
+
+def finish_setup(secure_adb, file_system_name=None):
+    # set it back to read-only fs
+    adb_shell("mount -o ro,remount /")
+
+    # locks the system
+    if(secure_adb):
+        logger.info("Securing adb ...")
+        adb_shell("setprop", "persist.adb.secure", "1")
+        logger.info("Done.")
+
+    update_inventory(file_system_name)
+
+    logger.info("Flo Edge Setup complete!")
+    logger.info("Rebooting in 5s...")
+    time.sleep(5)
+    adb("reboot")
+
+def setup_tasks(file_system_name, setup_ssh, secure_adb, host_image, after, streaming=False, tee=False):
+    """Steps of setup_device() including their downloads, to run after the task named after
+
+    With streaming, a file system that is not cached goes from S3 straight to
+    the device, kept on the host too with tee.
+    """
+    steps = [tasks.Task("write_scripts", write_boot_up_scripts)]
+    # device steps stay in their usual order, each waits for the previous one
+    device_step = after
+
+    if file_system_name:
+        config_file = f"{LOCAL_SETUP_DIR}/{file_system_name}.conf"
+        file_system_file = f"{LOCAL_SETUP_DIR}/{file_system_name}-rootfs.tar.gz"
+        steps += [
+            tasks.Task("download_config", download_fs_config, [], file_system_name),
+            # 1. Push config File
+            tasks.Task("start_anx", start_anx_app, [device_step, "download_config"], config_file),
+        ]
+        streaming = streaming and not host_image and not bundled(file_system_file) \
+            and not os.path.isfile(file_system_file)
+        if not streaming:
+            steps.append(tasks.Task("download_fs", download_file_system, [], file_system_name))
+
+        if streaming:
+            # 2. stream file system
+            # 3. Deploy the File system
+            steps += [
+                tasks.Task("stream_fs", stream_file_system, ["start_anx"], file_system_name, tee),
+                tasks.Task("deploy_fs", setup_chroot_env, ["stream_fs"]),
+            ]
+            device_step = "deploy_fs"
+        elif host_image:
+            # 2. build linux.img on the host, while the device installs apps, and upload it
+            steps += [
+                tasks.Task("build_image", build_rootfs_image, ["download_fs", "download_config"],
+                           file_system_name, file_system_file, config_file),
+                tasks.Task("upload_image", upload_rootfs_image, ["start_anx", "build_image"],
+                           file_system_name, config_file),
+            ]
+            device_step = "upload_image"
+        else:
+            # 2. push file system
+            # 3. Deploy the File system
+            steps += [
+                tasks.Task("push_fs", push_file_system, ["start_anx", "download_fs"], file_system_file),
+                tasks.Task("deploy_fs", setup_chroot_env, ["push_fs"]),
+            ]
+            device_step = "deploy_fs"
+
+    # 5. run adb ssh setup
+    if setup_ssh:
+        steps += [
+            tasks.Task("download_ssh", download_ssh_setup),
+            tasks.Task("ssh_setup", do_ssh_setup, [device_step, "download_ssh"]),
+        ]
+        device_step = "ssh_setup"
+
+    # 6. Copy adb keys
+    if secure_adb:
+        steps += [
+            tasks.Task("download_adb_keys", download_adb_setup),
+            tasks.Task("adb_setup", do_adb_setup, [device_step, "download_adb_keys"]),
+        ]
+        device_step = "adb_setup"
+
+    steps += [
+        tasks.Task("push_scripts", push_boot_up_scripts, [device_step, "write_scripts"]),
+        tasks.Task("finish", finish_setup, ["push_scripts"], secure_adb, file_system_name),
+    ]
+    return steps
+
+def setup_device(file_system_name, setup_ssh, secure_adb, host_image):
+    """Sets up a prepared device from the files in LOCAL_SETUP_DIR and reboots it
+
+    Arguments:
+        file_system_name -- file system to deploy, None to skip
+        setup_ssh -- flag to set up openssh-server
+        secure_adb -- flag to install adb keys and secure adb
+        host_image -- flag to build linux.img on the host
+    """
+    if file_system_name:
+        # 1. Push config File
+        config_file = f"{LOCAL_SETUP_DIR}/{file_system_name}.conf"
+        start_anx_app(config_file)
+
+        file_system_file = f"{LOCAL_SETUP_DIR}/{file_system_name}-rootfs.tar.gz"
+        if host_image:
+            # 2. build linux.img on the host and upload it
+            push_rootfs_image(file_system_name, file_system_file, config_file)
+        else:
+            # 2. push file system
+            push_file_system(file_system_file)
+
+            # 3. Deploy the File system
+            # 3.1 set profile to flo-linux
+            # 3.2 run `$LINUX_DEPLOY deploy`
+            setup_chroot_env()
+            # 4. wait for installation to finish
+
+    # 5. run adb ssh setup
+    if setup_ssh:
+        do_ssh_setup()
+
+    # 6. Copy adb keys
+    if(secure_adb):
+        do_adb_setup()
+
+    push_boot_up_scripts()
+    finish_setup(secure_adb, file_system_name)
 
 
 @click.command(name="local")
 @click.argument('filesystem_path')
 @click.argument('filesystem_config_path')
-def local_setup(filesystem_path, filesystem_config_path):
+@click.option('--host-image', '-i', is_flag=True, help='Builds linux.img on this PC instead of deploying on the device.')
+def local_setup(filesystem_path, filesystem_config_path, host_image):
     """
     Local boostrap setup of file system
 
@@ -393,13 +728,21 @@ def local_setup(filesystem_path, filesystem_config_path):
     push_config_file(filesystem_config_path)
     adb_shell(f"am start -n {APP_PACKAGE_NAME}/{APP_NAME}.activity.MainActivity")
 
-    # 2. push file system
-    push_file_system(filesystem_path)
+    file_system_name = os.path.basename(filesystem_path).split(".tar.gz")[0]
+    file_system_name = file_system_name.split("-rootfs")[0]
+    if host_image:
+        # 2. build linux.img on the host and upload it
+        push_rootfs_image(file_system_name, filesystem_path, filesystem_config_path)
+    else:
+        # 2. push file system
+        push_file_system(filesystem_path)
+
+        # 3. Deploy the File system
+        # 3.1 set profile to flo-linux
+        # 3.2 run `$LINUX_DEPLOY deploy`
+        setup_chroot_env()
 
-    # 3. Deploy the File system
-    # 3.1 set profile to flo-linux
-    # 3.2 run `$LINUX_DEPLOY deploy`
-    setup_chroot_env()
+    update_inventory(file_system_name)
 
     logger.info("Flo Edge Setup complete!")
     logger.info("Rebooting in 5s...")
@@ -418,7 +761,10 @@ def clean():
 @click.option('--setup-fs', '-f', is_flag=True, help='Download a file system upload it to your Flo Edge')
 @click.option('--setup-ssh', '-s', is_flag=True, help='Sets up openssh-server on your Flo Edge ')
 @click.option('--secure-adb', '-a', is_flag=True, help='Sets up adb keys on your Flo Edge and secures it.')
-def remote_setup(setup_fs, setup_ssh, secure_adb):
+@click.option('--host-image', '-i', is_flag=True, help='Builds linux.img on this PC instead of deploying on the device.')
+@click.option('--stream', '-S', 'streaming', is_flag=True, help='Streams the file system to your Flo Edge without keeping it on this PC.')
+@click.option('--tee', '-t', is_flag=True, help='With --stream, also keeps the file system in the setup folder.')
+def remote_setup(setup_fs, setup_ssh, secure_adb, host_image, streaming, tee):
     """
     Download and setup a file system.
 
@@ -435,58 +781,22 @@ def remote_setup(setup_fs, setup_ssh, secure_adb):
         click.echo(ctx.get_help())
         sys.exit(0)
     
-    pre_setup()
-    
+    create_s3_client()
+
+    file_system_name = None
     if setup_fs:
         file_system_name = populate_and_select_file_systems()
 
-        download_fs_config(file_system_name)
-        download_file_system(file_system_name)
-
-        # 1. Push config File
-        config_file = f"{LOCAL_SETUP_DIR}/{file_system_name}.conf"
-        push_config_file(config_file)
-        adb_shell(f"am start -n {APP_PACKAGE_NAME}/{APP_NAME}.activity.MainActivity")
-
-        # 2. push file system
-        file_system_file = f"{LOCAL_SETUP_DIR}/{file_system_name}-rootfs.tar.gz"
-        push_file_system(file_system_file)
-
-        # 3. Deploy the File system
-        # 3.1 set profile to flo-linux
-        # 3.2 run `$LINUX_DEPLOY deploy`
-        setup_chroot_env()
-        # 4. wait for installation to finish
-
-    # 5. run adb ssh setup
-    if setup_ssh:
-        download_ssh_setup()
-        do_ssh_setup()
-
-    # 6. Copy adb keys
-    if(secure_adb):
-        download_adb_setup()
-        do_adb_setup()
-
-    create_boot_up_script(setup_ssh)
-
-    # set it back to read-only fs
-    adb_shell("mount -o ro,remount /")
-
-    # locks the system
-    if(secure_adb):
-        logger.info("Securing adb ...")
-        adb_shell("setprop", "persist.adb.secure", "1")
-        logger.info("Done.")
-
-    logger.info("Flo Edge Setup complete!")
-    logger.info("Rebooting in 5s...")
-    time.sleep(5)
-    adb("reboot")
+    # all downloads start at once, device steps follow as their files arrive
+    tasks.run(pre_setup_tasks() + setup_tasks(
+        file_system_name, setup_ssh, secure_adb, host_image, after="grant_permissions",
+        streaming=streaming, tee=tee))
 
 @click.group()
 @click.version_option(version="", message=f"Flo OS bootstrap utility : {VERSION}")
-def cli():
+@click.option('--bundle', '-b', 'bundle_file', envvar="FLO_BUNDLE", type=click.Path(exists=True),
+              help='Offline bundle to take platform tools, apks and file systems from, see ./bundle.')
+def cli(bundle_file):
     """
     Flo OS bootstrap utility
 
@@ -503,8 +813,15 @@ def cli():
     2. For local based file system setup, the file system must be a .tar.gz file.
 
     3. To setup ssh and secure_adb, as of now it's only possible with remote
+
+    4. With --bundle, remote takes every file from the bundle, without internet.
     """
-    pass
+    if bundle_file:
+        try:
+            bundle.use(bundle_file)
+        except package.PackageException as e:
+            logger.error(e.message)
+            sys.exit(1)
 
 cli.add_command(remote_setup)
 cli.add_command(local_setup)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+# Offline provisioning bundle (.flobundle)
+#
+# A .flopkg container of kind "bundle" holding everything flash and
+# bootstrap would otherwise download, under these names:
+#
+#   platform-tools/<platform>.zip   platform-tools for linux, windows, darwin
+#   builds/<version>.flopkg         Flo OS builds, flashed straight from the bundle
+#   setup/<file>                    apks, file systems, their configs, ssh and adb key zips
+#
+# Entries are stored uncompressed, so every artifact is one contiguous range
+# of the bundle. Builds are opened in place as packages at their offset and
+# setup files are streamed to the device from the memory mapping.
+
+VERSION = "v0.1.0"
+
+import io
+import os
+import re
+import sys
+import glob
+import shlex
+import shutil
+import platform
+import tempfile
+import zipfile
+import subprocess
+import urllib.request as request
+
+import click
+
+import logger
+import progress
+import package
+
+EXTENSION = ".flobundle"
+PLATFORM_TOOLS_PREFIX = "platform-tools/"
+BUILDS_PREFIX = "builds/"
+SETUP_PREFIX = "setup/"
+ROOTFS_SUFFIX = "-rootfs.tar.gz"
+SETUP_FILES = ["magisk.apk", "anx.apk"]
+# only needed by bootstrap --ssh and --secure-adb
+OPTIONAL_SETUP_FILES = ["ssh_setup.zip", "adb_keys.zip"]
+
+PLATFORM_TOOLS_VERSION = "r34.0.0"
+PLATFORM = platform.uname().system.lower()
+PLATFORM_TOOLS_FILE_PATTERN = re.compile(r"(linux|windows|darwin)\.zip$")
+SETUP_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "setup")
+
+# bundle given with --bundle, None when artifacts come from S3
+current = None
+
+
+def use(file_name):
+    """Serves artifacts from file_name for the rest of the run, None to stop"""
+    global current
+    if current is not None:
+        current.close()
+    current = Bundle(file_name) if file_name else None
+
+
+class EntryReader(io.RawIOBase):
+    """Seekable read-only file over a stored entry, reading from the mapping"""
+
+    def __init__(self, data, start, size):
+        self._data = data
+        self._start = start
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        length = max(0, min(len(buffer), self._size - self._pos))
+        start = self._start + self._pos
+        buffer[:length] = self._data[start:start + length]
+        self._pos += length
+        return length
+
+
+class Bundle(package.Package):
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        if self.kind != "bundle":
+            raise package.PackageException(f"{file_name} is not an offline bundle")
+
+    def _names(self, prefix, suffix=""):
+        return [name[len(prefix):len(name) - len(suffix)] for name in self.entries
+                if name.startswith(prefix) and name.endswith(suffix)]
+
+    def builds(self):
+        return self._names(BUILDS_PREFIX, package.EXTENSION)
+
+    def file_systems(self):
+        return self._names(SETUP_PREFIX, ROOTFS_SUFFIX)
+
+    def build_offset(self, version):
+        """Offset of a build's package in the bundle, to open it with package.Package"""
+        return self.offset + self.entries[f"{BUILDS_PREFIX}{version}{package.EXTENSION}"]["offset"]
+
+    def setup_entry(self, file_name):
+        """Name of the bundled setup file for a path in the setup directory, None if missing"""
+        name = f"{SETUP_PREFIX}{os.path.basename(file_name)}"
+        return name if name in self.entries else None
+
+    def reader(self, name):
+        entry = self.entries[name]
+        return EntryReader(memoryview(self._mapped()), self.offset + entry["offset"], entry["size"])
+
+    def extract_platform_tools(self, platform_name=PLATFORM, dest="."):
+        """Unpacks platform-tools for platform_name into dest
+
+        Returns:
+            False if the bundle has none for the platform
+        """
+        name = f"{PLATFORM_TOOLS_PREFIX}{platform_name}.zip"
+        if name not in self.entries:
+            return False
+        logger.info("Unpacking platform tools from bundle ...")
+        with zipfile.ZipFile(self.reader(name)) as archive:
+            for info in archive.infolist():
+                path = archive.extract(info, dest)
+                # zipfile drops the permission bits, adb and fastboot need theirs
+                mode = info.external_attr >> 16
+                if mode:
+                    os.chmod(path, mode & 0o7777)
+        logger.info("Done.")
+        return True
+
+    def _exec_in(self, adb_cmd, command, name):
+        size = self.entries[name]["size"]
+        proc = subprocess.Popen(adb_cmd + ["exec-in", command],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            with progress.track(os.path.basename(name), size) as transfer:
+                for chunk in self.chunks(name):
+                    proc.stdin.write(chunk)
+                    transfer.update(len(chunk))
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+        output = proc.stdout.read().decode() + proc.stderr.read().decode()
+        return proc.wait(), output.rstrip()
+
+    def push(self, adb_cmd, name, remote_path):
+        """Streams a bundled file to remote_path on the device
+
+        Arguments:
+            adb_cmd -- the adb invocation as a list, e.g. [ADB] or [ADB, "-s", serial]
+            name -- entry name in the bundle
+            remote_path -- destination file on the device
+        """
+        returncode, output = self._exec_in(adb_cmd, f"cat > {shlex.quote(remote_path)}", name)
+        if returncode != 0:
+            logger.error(f"Error in pushing {name} : {output}")
+            raise SystemExit(returncode)
+
+    def install(self, adb_cmd, name):
+        """Installs a bundled apk, streaming it to the package manager like adb install does"""
+        size = self.entries[name]["size"]
+        returncode, output = self._exec_in(adb_cmd, f"cmd package install -S {size}", name)
+        if returncode != 0 or "Success" not in output:
+            logger.error(f"Error in installing {name} : {output}")
+            raise SystemExit(returncode or 1)
+
+
+def _file_opener(path):
+    return lambda: open(path, "rb")
+
+
+def create(output, platform_tools, builds, setup_files):
+    """Writes a bundle
+
+    Arguments:
+        output -- path of the bundle to create
+        platform_tools -- platform name to platform-tools zip
+        builds -- Flo OS builds, as .zip files or packages
+        setup_files -- bootstrap files to include, named as in the setup directory
+
+    Returns:
+        the index
+    """
+    artifacts = []
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        for platform_name, path in sorted(platform_tools.items()):
+            artifacts.append((f"{PLATFORM_TOOLS_PREFIX}{platform_name}.zip", _file_opener(path)))
+        for path in builds:
+            version = os.path.basename(path).split(".zip")[0].split(package.EXTENSION)[0]
+            if not package.is_package(path):
+                # builds are flashed in place, so zips are repacked as stored packages
+                logger.info(f"Packing {os.path.basename(path)} ...")
+                packed = os.path.join(work_dir, f"{version}{package.EXTENSION}")
+                package.create(packed, package.list_images(path), version=version)
+                path = packed
+            artifacts.append((f"{BUILDS_PREFIX}{version}{package.EXTENSION}", _file_opener(path)))
+        for path in setup_files:
+            artifacts.append((f"{SETUP_PREFIX}{os.path.basename(path)}", _file_opener(path)))
+
+        logger.info(f"Writing {len(artifacts)} artifacts into {output} ...")
+        return package.create(output, artifacts, kind="bundle")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def download_platform_tools(platform_name, dest_dir):
+    url = (f"https://dl.google.com/android/repository/"
+           f"platform-tools_{PLATFORM_TOOLS_VERSION}-{platform_name}.zip")
+    file_name = os.path.join(dest_dir, f"{platform_name}.zip")
+    logger.info(f"Downloading platform tools for {platform_name} ...")
+    with progress.track(os.path.basename(url)) as transfer:
+        def report(count, block_size, total_size):
+            if total_size > 0:
+                transfer.total = total_size
+                transfer.set(min(count * block_size, total_size))
+        request.urlretrieve(url, file_name, report)
+    return file_name
+
+
+@click.command(name="create")
+@click.argument("output")
+@click.option('--build', '-b', 'builds', multiple=True, type=click.Path(exists=True),
+              help='Flo OS build (.zip or .flopkg), can be repeated.')
+@click.option('--file-system', '-f', 'file_systems', multiple=True,
+              help='File system in the setup directory, can be repeated. Defaults to all of them.')
+@click.option('--setup-dir', '-s', default=SETUP_DIR, show_default=True, type=click.Path(exists=True),
+              help='Directory with the files bootstrap downloaded.')
+@click.option('--platform-tools', '-p', 'platform_tools', multiple=True, type=click.Path(exists=True),
+              help='platform-tools zip, named after its platform. Downloaded for this PC when not given.')
+def create_bundle(output, builds, file_systems, setup_dir, platform_tools):
+    """Create an offline bundle.
+
+    Packs platform-tools, Flo OS builds, file systems with their configs
+    and the apks into OUTPUT, for flash and bootstrap --bundle.
+    Run `bootstrap remote` once to fill the setup directory.
+    """
+    setup_files = []
+    for name in SETUP_FILES + OPTIONAL_SETUP_FILES:
+        path = os.path.join(setup_dir, name)
+        if os.path.isfile(path):
+            setup_files.append(path)
+        elif name in SETUP_FILES:
+            logger.error(f"{name} not found in {setup_dir}")
+            sys.exit(1)
+        else:
+            logger.warn(f"{name} not found in {setup_dir}, bootstrap --bundle can't use it.")
+    if not file_systems:
+        file_systems = [os.path.basename(path)[:-len(ROOTFS_SUFFIX)]
+                        for path in sorted(glob.glob(os.path.join(setup_dir, f"*{ROOTFS_SUFFIX}")))]
+    for file_system_name in file_systems:
+        for file_name in (f"{file_system_name}{ROOTFS_SUFFIX}", f"{file_system_name}.conf"):
+            path = os.path.join(setup_dir, file_name)
+            if not os.path.isfile(path):
+                logger.error(f"{file_name} not found in {setup_dir}")
+                sys.exit(1)
+            setup_files.append(path)
+
+    download_dir = tempfile.mkdtemp()
+    try:
+        tools = {}
+        for path in platform_tools:
+            match = PLATFORM_TOOLS_FILE_PATTERN.search(path)
+            tools[match.group(1) if match else PLATFORM] = path
+        if not tools:
+            tools[PLATFORM] = download_platform_tools(PLATFORM, download_dir)
+
+        try:
+            index = create(output, tools, builds, setup_files)
+        except package.PackageException as e:
+            logger.error(e.message)
+            sys.exit(1)
+    finally:
+        shutil.rmtree(download_dir)
+    total_size = sum(entry["size"] for entry in index["entries"])
+    logger.info(f"Done. {len(index['entries'])} artifacts, {progress.format_bytes(total_size)}")
+
+
+@click.command(name="list")
+@click.argument("bundle_file", type=click.Path(exists=True))
+def list_bundle(bundle_file):
+    """List the artifacts in a bundle."""
+    try:
+        with Bundle(bundle_file) as bundle:
+            for name, entry in bundle.entries.items():
+                click.echo(f"{progress.format_bytes(entry['size']):>10}  {name}")
+    except package.PackageException as e:
+        logger.error(e.message)
+        sys.exit(1)
+
+
+@click.group()
+@click.version_option(version="", message=f"Flo OS bundle utility : {VERSION}")
+def cli():
+    """Flo OS offline bundle utility
+
+    A bundle holds everything flash and bootstrap download, for stations
+    without internet. Pass it with --bundle (or FLO_BUNDLE) to either tool.
+    """
+    pass
+
+
+cli.add_command(create_bundle)
+cli.add_command(list_bundle)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,277 @@
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+# Chunk level delta downloads
+#
+# An artifact is cut into content defined chunks and described by an index
+# (<artifact>.chunks) published next to it. To download a new version only
+# the chunks that no cached artifact already has are fetched, with ranged
+# GETs, and the rest is copied from the local files.
+#
+# Chunk boundaries are picked on BLOCK_SIZE boundaries, after a block whose
+# crc32 matches BOUNDARY_MASK. Partition images and .flopkg packages are
+# block aligned, so identical files or blocks give identical chunks wherever
+# they moved to, and the scan runs at crc32 speed instead of a per byte
+# rolling hash in Python.
+
+import os
+import glob
+import json
+import time
+import zlib
+import hashlib
+import threading
+import concurrent.futures as futures
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import logger
+import progress
+import tasks
+
+FORMAT_VERSION = 1
+EXTENSION = ".chunks"
+BLOCK_SIZE = 4096
+# a boundary after 1 in 256 blocks, ~1MB chunks on average
+BOUNDARY_MASK = 0xFF
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+FETCH_WORKERS = 4
+# missing chunks separated by less than this are fetched in one request
+MAX_RANGE_GAP = 256 * 1024
+
+
+def build_index(file_name):
+    """Chunks a file and returns its index"""
+    chunks = []
+    whole = hashlib.sha256()
+    digest = hashlib.sha256()
+    length = 0
+    size = 0
+    with open(file_name, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            whole.update(data)
+            view = memoryview(data)
+            for pos in range(0, len(view), BLOCK_SIZE):
+                block = view[pos:pos + BLOCK_SIZE]
+                digest.update(block)
+                length += len(block)
+                if length >= MAX_CHUNK_SIZE or (
+                        length >= MIN_CHUNK_SIZE and zlib.crc32(block) & BOUNDARY_MASK == 0):
+                    chunks.append([digest.hexdigest(), length])
+                    digest = hashlib.sha256()
+                    length = 0
+            size += len(data)
+    if length:
+        chunks.append([digest.hexdigest(), length])
+    return {
+        "format": FORMAT_VERSION,
+        "size": size,
+        "sha256": whole.hexdigest(),
+        "block_size": BLOCK_SIZE,
+        "chunks": chunks,
+    }
+
+
+def save_index(index, file_name):
+    with open(file_name, "w") as f:
+        json.dump(index, f)
+
+
+def load_index(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def index_file(file_name):
+    """Writes <file_name>.chunks and returns the index"""
+    index = build_index(file_name)
+    save_index(index, f"{file_name}{EXTENSION}")
+    return index
+
+
+class ChunkStore:
+    """Chunks available in the artifacts of a local cache directory"""
+
+    def __init__(self, cache_dir):
+        self.locations = {}
+        for index_name in glob.glob(os.path.join(cache_dir, f"*{EXTENSION}")):
+            artifact = index_name[:-len(EXTENSION)]
+            if not os.path.isfile(artifact):
+                continue
+            try:
+                index = load_index(index_name)
+            except (OSError, ValueError):
+                continue
+            if index.get("size") != os.path.getsize(artifact):
+                continue
+            offset = 0
+            for sha256, length in index["chunks"]:
+                self.locations.setdefault(sha256, (artifact, offset, length))
+                offset += length
+
+    def __len__(self):
+        return len(self.locations)
+
+    def get(self, sha256):
+        return self.locations.get(sha256)
+
+
+def index_cache(cache_dir, patterns):
+    """Indexes cached artifacts that were downloaded before indexes existed"""
+    for pattern in patterns:
+        for artifact in glob.glob(os.path.join(cache_dir, pattern)):
+            if not os.path.isfile(f"{artifact}{EXTENSION}"):
+                logger.info(f"Indexing {os.path.basename(artifact)} ...")
+                index_file(artifact)
+
+
+def plan(index, store):
+    """Splits an index into local copies and remote ranges
+
+    Returns:
+        (local, remote) -- local is a list of (dest offset, file, offset, length),
+        remote a list of (start, end) byte ranges to fetch
+    """
+    local = []
+    remote = []
+    offset = 0
+    for sha256, length in index["chunks"]:
+        location = store.get(sha256)
+        if location is not None:
+            local.append((offset, location[0], location[1], length))
+        elif remote and offset - remote[-1][1] <= MAX_RANGE_GAP:
+            remote[-1] = (remote[-1][0], offset + length)
+        else:
+            remote.append((offset, offset + length))
+        offset += length
+    return local, remote
+
+
+def _fetch_range(s3, bucket, key, start, end, fd, transfer, stops):
+    if any(stop.is_set() for stop in stops):
+        raise tasks.Cancelled()
+    body = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}")["Body"]
+    offset = start
+    for data in body.iter_chunks(1024 * 1024):
+        if any(stop.is_set() for stop in stops):
+            body.close()
+            raise tasks.Cancelled()
+        os.pwrite(fd, data, offset)
+        offset += len(data)
+        transfer.update(len(data))
+    if offset != end:
+        raise IOError(f"Short read for bytes {start}-{end - 1} of {key}")
+
+
+def _copy_local(local, fd, transfer):
+    opened = {}
+    try:
+        for dest_offset, file_name, offset, length in local:
+            if file_name not in opened:
+                opened[file_name] = open(file_name, "rb")
+            src = opened[file_name]
+            src.seek(offset)
+            os.pwrite(fd, src.read(length), dest_offset)
+            transfer.update(length)
+    finally:
+        for src in opened.values():
+            src.close()
+
+
+def fetch_index(s3, bucket, key):
+    try:
+        body = s3.get_object(Bucket=bucket, Key=f"{key}{EXTENSION}")["Body"]
+    except ClientError:
+        return None
+    return json.loads(body.read())
+
+
+def delta_download(s3, bucket, key, dest, cache_dir, patterns):
+    """Downloads key to dest, fetching only chunks missing from cache_dir
+
+    Cached artifacts matching patterns that have no index yet are indexed
+    first, as long as key has a published index.
+
+    Returns:
+        False when no chunk index is published for key, nothing can be
+        reused or rebuilding failed, so the caller should do a full
+        download. True otherwise.
+    """
+    if not hasattr(os, "pwrite"):
+        # rebuilding writes ranges in place, not available on windows
+        return False
+    index = fetch_index(s3, bucket, key)
+    if index is None or index.get("format") != FORMAT_VERSION:
+        return False
+    index_cache(cache_dir, patterns)
+    store = ChunkStore(cache_dir)
+    local, remote = plan(index, store)
+    if not local:
+        # keep the index, so later versions can reuse this download
+        save_index(index, f"{dest}{EXTENSION}")
+        return False
+
+    size = index["size"]
+    fetch_size = sum(end - start for start, end in remote)
+    logger.info(f"Reusing {progress.format_bytes(size - fetch_size)} from cache, "
+                f"downloading {progress.format_bytes(fetch_size)} in {len(remote)} ranges ...")
+
+    start_time = time.monotonic()
+    # the fetches run on their own threads, so they are given the step's event,
+    # and their own to stop the others once one of them failed
+    stops = (tasks.cancel_event(), threading.Event())
+    part = f"{dest}.part"
+    fd = os.open(part, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with progress.track(os.path.basename(dest), size) as transfer:
+            with futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+                jobs = [executor.submit(_fetch_range, s3, bucket, key, start, end, fd, transfer, stops)
+                        for start, end in remote]
+                try:
+                    _copy_local(local, fd, transfer)
+                    for job in jobs:
+                        job.result()
+                except BaseException:
+                    stops[1].set()
+                    raise
+    except (BotoCoreError, ClientError, OSError) as e:
+        os.close(fd)
+        os.remove(part)
+        logger.warn(f"Rebuilding {key} failed, downloading it in full : {e}")
+        return False
+    except BaseException:
+        os.close(fd)
+        os.remove(part)
+        raise
+    os.close(fd)
+    elapsed = time.monotonic() - start_time
+
+    digest = hashlib.sha256()
+    with open(part, "rb") as f:
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(data)
+    if digest.hexdigest() != index["sha256"]:
+        os.remove(part)
+        logger.warn(f"Rebuilt {key} does not match its index, downloading it in full.")
+        return False
+
+    os.replace(part, dest)
+    save_index(index, f"{dest}{EXTENSION}")
+    saved = size - fetch_size
+    message = f"Saved {progress.format_bytes(saved)} ({100 * saved / size:.0f}%) of downloads"
+    if fetch_size and elapsed:
+        # time a full download would have taken at the rate just seen
+        saved_time = saved / (fetch_size / elapsed)
+        message += f" and ~{progress.format_eta(saved_time)} of download time"
+    logger.info(message)
+    return True
@@ -19,13 +19,24 @@ import platform
 import time
 import urllib.request as request
 import shutil
+import contextlib
+import tempfile
+import hashlib
+import concurrent.futures as futures
 
 import click
 import boto3
-import alive_progress as alive
+from botocore.exceptions import BotoCoreError, ClientError
 from simple_term_menu import TerminalMenu
 
 import logger
+import progress
+import package
+import chunks
+import bundle
+import stream
+import inventory
+from utils import get_serial, serial_args
 
 SCRIPT_DIR=os.path.abspath(os.path.dirname(__file__))
 CACHE_DIR=""
@@ -44,6 +55,8 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_S3_REGION_NAME = os.getenv("AWS_S3_REGION_NAME")
 
 FLO_OS_RELEASES_BUCKET_NAME = "flo-os-release-bundles"
+# images hashed for the inventory at once, next to the one being flashed
+HASH_WORKERS = 2
 s3 = None
 
 if PLATFORM == "windows":
@@ -55,7 +68,7 @@ else:
 
 
 def fastboot(cmd, *args):
-    return subprocess.run([FASTBOOT, cmd] + list(args))
+    return subprocess.run([FASTBOOT] + serial_args() + [cmd] + list(args))
 
 
 def check_aws_credentials():
@@ -66,10 +79,14 @@ def check_aws_credentials():
 
 
 def download_file(url, filename):
-    with alive.alive_bar() as bar:
-        def progress(count, block_size, total_size):
-            bar()
-        request.urlretrieve(url, filename, progress)
+    with progress.track(filename) as transfer:
+        def report(count, block_size, total_size):
+            if total_size > 0:
+                transfer.total = total_size
+                transfer.set(min(count * block_size, total_size))
+            else:
+                transfer.set(count * block_size)
+        request.urlretrieve(url, filename, report)
 
 
 def unzip_platform_tools():
@@ -83,6 +100,9 @@ def unzip_platform_tools():
 
 
 def check_platform_tools():
+    if not os.path.exists('platform-tools') and bundle.current is not None:
+        if bundle.current.extract_platform_tools(PLATFORM):
+            return
     logger.info('Downloading platform tools...')
     if not os.path.exists('platform-tools'):
         download_file(PLATFORM_TOOLS_URL, 'platform-tools.zip')
@@ -102,6 +122,10 @@ def populate_and_select_os_versions():
     with open(f'{CACHE_DIR}/manifest') as f:
         versions = f.read()
         versions = versions.rstrip().split("\n")
+    return select_os_version(versions)
+
+
+def select_os_version(versions):
     terminal_menu = TerminalMenu(
         menu_entries=versions,
         title="Available versions of Flo OS")
@@ -109,34 +133,45 @@ def populate_and_select_os_versions():
     return versions[selected_version_index]
 
 
+def local_build_path(version):
+    """Returns the cached build for version, preferring a package over a zip"""
+    for extension in (package.EXTENSION, ".zip"):
+        file_name = f"{CACHE_DIR}/{version}{extension}"
+        if os.path.isfile(file_name):
+            return file_name
+    return None
+
+
 def check_for_local_build(version):
-    file_name = f"{version}.zip"
-    return os.path.isfile(f"{CACHE_DIR}/{file_name}")
+    return local_build_path(version) is not None
 
 
 def download_flo_build(version):
-    file_name = f"{version}.zip"
-    build_file_data = s3.get_object(
-        Bucket=FLO_OS_RELEASES_BUCKET_NAME,
-        Key=file_name
-    )
+    # releases published with `flash pack` are preferred over plain zips
+    for extension in (package.EXTENSION, ".zip"):
+        file_name = f"{version}{extension}"
+        try:
+            build_file_data = s3.head_object(
+                Bucket=FLO_OS_RELEASES_BUCKET_NAME,
+                Key=file_name
+            )
+            break
+        except ClientError:
+            if extension == ".zip":
+                raise
     total_size = build_file_data["ContentLength"]
     logger.info(f'Downloading Flo OS : {version} ...')
-    with alive.alive_bar(manual=True) as bar:
-        global bytes_seen
-        bytes_seen = 0
-
-        def progress(bytes):
-            # logger.info(f"Downloaded {bytes} bytes so far")
-            global bytes_seen
-            bytes_seen = bytes_seen + bytes
-            percent = (bytes_seen / total_size)
-            bar(percent)
+    if chunks.delta_download(s3, FLO_OS_RELEASES_BUCKET_NAME, file_name, f'{CACHE_DIR}/{file_name}',
+                             CACHE_DIR, ["*.zip", f"*{package.EXTENSION}"]):
+        logger.info('Done.')
+        return
+    # boto3 reports progress from several threads, Transfer.update is thread-safe
+    with progress.track(file_name, total_size) as transfer:
         s3.download_file(
             Bucket=FLO_OS_RELEASES_BUCKET_NAME,
             Key=file_name,
             Filename=f'{CACHE_DIR}/{file_name}',
-            Callback=progress)
+            Callback=transfer.update)
     logger.info(f'Done.')
 
 
@@ -144,21 +179,45 @@ def flash_partition(partition_name, img_file):
     return fastboot("flash", partition_name, img_file)
 
 
-def flash_flo_build(file_name, wipe) -> bool:
+def file_sha256(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for data in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def fastboot_serial():
+    """Serial of the device being flashed, the only one in fastboot when none was picked"""
+    if get_serial():
+        return get_serial()
+    ret = subprocess.run([FASTBOOT, "devices"], capture_output=True)
+    lines = ret.stdout.decode().split()
+    return lines[0] if lines else None
+
+
+def flash_flo_build(file_name, wipe, offset=0) -> bool:
     """Flashes flo os build via fastboot
 
     Arguments:
-        file_name -- a .zip file
+        file_name -- a .zip file or package
         wipe -- flag to perform factory reset
+        offset -- where the package starts in file_name, for builds in a bundle
 
     Returns:
-        True if successful
+        True if successful, False if a partition failed to flash
     """
     if wipe:
         perform_factory_reset()
 
+    if package.is_package(file_name, offset):
+        return flash_package(file_name, offset)
+
     logger.info(f"Unzipping {file_name} ...")
     dir_name = file_name.split(".zip")[0]
+    if get_serial():
+        # several devices may be flashing the same build at once
+        dir_name = f"{dir_name}-{get_serial()}"
     dir_name = os.path.join(os.getcwd(), os.path.abspath(dir_name))
     file_name = os.path.abspath(file_name)
     # unzip file
@@ -177,15 +236,25 @@ def flash_flo_build(file_name, wipe) -> bool:
     logger.info("Done")
 
     image_file_pattern = re.compile(r"\w+\.img")
-    # flash individual partitions
-    for file in os.listdir(dir_name):
-        if image_file_pattern.match(file):
-            partition_name = file.split(".img")[0]
-            logger.info(f"Flashing {file} into {partition_name} partition")
-            ret = flash_partition(partition_name, os.path.join(dir_name, file))
-            if ret.returncode != 0:
-                logger.error(
-                    f"Failed flashing {partition_name} : {ret.stderr.decode()}")
+    images = [file for file in os.listdir(dir_name) if image_file_pattern.match(file)]
+    total_size = sum(os.path.getsize(os.path.join(dir_name, file)) for file in images)
+    failed = []
+    # hashed for the inventory while fastboot flashes, instead of reading every image again after it
+    with futures.ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash") as executor:
+        hashes = {file: executor.submit(file_sha256, os.path.join(dir_name, file)) for file in images}
+        # flash individual partitions
+        with progress.track("Flashing", total_size) as transfer:
+            for file in images:
+                partition_name = file.split(".img")[0]
+                logger.info(f"Flashing {file} into {partition_name} partition")
+                ret = flash_partition(partition_name, os.path.join(dir_name, file))
+                if ret.returncode != 0:
+                    logger.error(f"Failed flashing {partition_name}")
+                    failed.append(partition_name)
+                transfer.update(os.path.getsize(os.path.join(dir_name, file)))
+        partition_hashes = {file.split(".img")[0]: future.result() for file, future in hashes.items()
+                            if file.split(".img")[0] not in failed}
+    inventory.record_flash(fastboot_serial(), os.path.basename(file_name).split(".zip")[0], partition_hashes)
 
     # clean up
     if os.path.exists(dir_name):
@@ -193,12 +262,104 @@ def flash_flo_build(file_name, wipe) -> bool:
         shutil.rmtree(dir_name)
         logger.info("Done.")
 
-    return True
+    return not failed
+
+
+def flash_package(file_name, offset=0) -> bool:
+    """Flashes the partitions of a .flopkg in its index order
+
+    Each image is verified against its sha256 and cloned out of the package
+    next to it right before it is flashed, one partition at a time.
+
+    Returns:
+        True if successful, False on a checksum mismatch or if a partition failed to flash
+    """
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(file_name)))
+    partition_hashes = {}
+    failed = []
+    try:
+        with package.Package(file_name, offset) as pkg:
+            total_size = sum(pkg.entries[name]["size"] for name in pkg.flash_order)
+            with progress.track("Flashing", total_size) as transfer:
+                for partition_name in pkg.flash_order:
+                    if not pkg.verify(partition_name):
+                        logger.error(f"Checksum mismatch for {partition_name} in {file_name}")
+                        return False
+                    img_file = os.path.join(work_dir, f"{partition_name}.img")
+                    pkg.extract(partition_name, img_file)
+                    logger.info(f"Flashing {partition_name}.img into {partition_name} partition")
+                    ret = flash_partition(partition_name, img_file)
+                    os.remove(img_file)
+                    if ret.returncode != 0:
+                        logger.error(f"Failed flashing {partition_name}")
+                        failed.append(partition_name)
+                    else:
+                        partition_hashes[partition_name] = pkg.entries[partition_name]["sha256"]
+                    transfer.update(pkg.entries[partition_name]["size"])
+            build = pkg.version or os.path.basename(file_name).split(package.EXTENSION)[0]
+    finally:
+        shutil.rmtree(work_dir)
+    inventory.record_flash(fastboot_serial(), build, partition_hashes)
+    return not failed
+
+
+def flash_streamed_build(version, wipe, tee):
+    """Flashes a published package while it downloads, one partition on disk at a time
+
+    Arguments:
+        version -- Flo OS version
+        wipe -- flag to perform factory reset
+        tee -- flag to also keep the package in CACHE_DIR
+
+    Returns:
+        None if no package is published for version, True if successful,
+        False if the download or a partition failed. Flashing stops at the
+        first partition that failed.
+    """
+    key = f"{version}{package.EXTENSION}"
+    try:
+        remote = stream.RemotePackage(s3, FLO_OS_RELEASES_BUCKET_NAME, key)
+    except ClientError:
+        return None
+    except (BotoCoreError, OSError) as e:
+        logger.error(f"Couldn't reach {key} : {e}")
+        return False
+
+    if wipe:
+        perform_factory_reset()
+
+    if not os.path.exists(CACHE_DIR):
+        os.mkdir(CACHE_DIR)
+    work_dir = tempfile.mkdtemp(dir=CACHE_DIR)
+    partition_hashes = {}
+    failed = []
+    logger.info(f"Streaming Flo OS : {version} ...")
+    try:
+        # closed right away on a failure or Ctrl+C, which stops the prefetch before work_dir goes
+        with contextlib.closing(remote.stream_images(work_dir, f"{CACHE_DIR}/{key}" if tee else None)) as images:
+            for partition_name, img_file in images:
+                logger.info(f"Flashing {partition_name}.img into {partition_name} partition")
+                ret = flash_partition(partition_name, img_file)
+                if ret.returncode != 0:
+                    logger.error(f"Failed flashing {partition_name}")
+                    failed.append(partition_name)
+                    break
+                partition_hashes[partition_name] = remote.entries[partition_name]["sha256"]
+    except package.PackageException as e:
+        logger.error(e.message)
+        return False
+    except (BotoCoreError, ClientError, OSError) as e:
+        logger.error(f"Streaming {key} failed : {e}")
+        return False
+    finally:
+        shutil.rmtree(work_dir)
+    inventory.record_flash(fastboot_serial(), remote.version or version, partition_hashes)
+    return not failed
 
 
 def adb_reboot_bootloader():
     logger.info('Rebooting into bootloader...')
-    ret = subprocess.run([ADB, 'reboot', 'bootloader'])
+    ret = subprocess.run([ADB] + serial_args() + ['reboot', 'bootloader'])
     if ret.returncode != 0:
         logger.error(ret.stderr.decode())
         return
@@ -209,7 +370,11 @@ def in_fastboot():
     try:
         ret = subprocess.run([FASTBOOT, "devices"],
                              capture_output=True, timeout=3)
-        return "fastboot" in ret.stdout.decode().rstrip().split("\t")
+        for line in ret.stdout.decode().rstrip().split("\n"):
+            fields = line.split("\t")
+            if "fastboot" in fields and (get_serial() is None or fields[0] == get_serial()):
+                return True
+        return False
     except subprocess.TimeoutExpired:
         return False
 
@@ -224,7 +389,7 @@ def wait_for_fastboot_device():
         "Couldn't find device in fastboot mode. Will try to reboot via adb.")
     # Check if the device is connected via ADB
     logger.info('Checking if the device is connected via ADB...')
-    ret = subprocess.run([ADB, "get-state"], capture_output=True, timeout=5)
+    ret = subprocess.run([ADB] + serial_args() + ["get-state"], capture_output=True, timeout=5)
 
     if "device" not in ret.stdout.decode():
         logger.error(
@@ -299,6 +464,60 @@ def cleanup():
         logger.info("Done.")
 
 
+@click.command(name="pack")
+@click.argument("source")
+@click.argument("output", required=False)
+@click.option('--compress', '-c', is_flag=True, help='Chunk-compresses images instead of storing them.')
+@click.option('--order', '-o', help='Comma separated partitions in flashing order. Defaults to the image order in SOURCE.')
+def pack(source, output, compress, order):
+    """Create a Flo OS package from a build.
+
+    SOURCE is a zip file or directory of partition images (.img).
+    OUTPUT defaults to SOURCE with a .flopkg extension.
+
+    Images are stored uncompressed by default, so flashing can copy them
+    straight out of the package.
+    """
+    source = source.rstrip("/\\")
+    version = os.path.basename(source).split(".zip")[0]
+    if output is None:
+        output = os.path.join(os.path.dirname(source), f"{version}{package.EXTENSION}")
+    images = package.list_images(source)
+    if not images:
+        logger.error(f"No partition images found in {source}")
+        sys.exit(1)
+
+    logger.info(f"Packing {len(images)} images into {output} ...")
+    try:
+        index = package.create(
+            output, images, version=version,
+            flash_order=order.split(",") if order else None,
+            compression="zlib" if compress else "none")
+    except package.PackageException as e:
+        logger.error(e.message)
+        sys.exit(1)
+    for entry in index["entries"]:
+        logger.info(f"{entry['name']} : {entry['size']} bytes, sha256 {entry['sha256'][:12]}"
+                    + (", sparse" if entry["sparse"] else ""))
+    logger.info("Done.")
+
+
+@click.command(name="index")
+@click.argument("files", nargs=-1, required=True)
+def index(files):
+    """Create chunk indexes for delta downloads.
+
+    Writes FILE.chunks next to each FILE. Upload it to the bucket next to
+    the build (or rootfs tarball) so hosts that have an older version
+    cached only download the chunks that changed.
+    """
+    for file_name in files:
+        logger.info(f"Indexing {file_name} ...")
+        file_index = chunks.index_file(file_name)
+        logger.info(f"{len(file_index['chunks'])} chunks, {file_index['size']} bytes")
+    logger.info("Done.")
+
+
 @click.command(name="local")
 @click.argument("os_zip_file")
 @click.option('--wipe', '-w', is_flag=True, help='Performs a factory reset and flash OS.')
@@ -306,7 +525,8 @@ def cleanup():
 def flash_local(wipe, reboot, os_zip_file):
     """Flash a local version of Flo OS.
 
-    Pass the path to the zip file containing all partitions as an argument.
+    Pass the path to the zip file containing all partitions, or a package
+    created with `flash pack`, as an argument.
 
     The zip file must contain all partition image files (.img) with the filename as the partition name.
 
@@ -326,9 +546,15 @@ def flash_local(wipe, reboot, os_zip_file):
 @click.command(name="remote")
 @click.option('--wipe', '-w', is_flag=True, help='Performs a factory reset and flash OS.')
 @click.option('--reboot', '-r', is_flag=True, help='Reboots after opertation is succesful')
-def flash_remote(wipe, reboot):
+@click.option('--stream', '-s', 'streaming', is_flag=True, help='Flashes a package while it downloads, without keeping the build.')
+@click.option('--tee', '-t', is_flag=True, help='With --stream, also keeps the package in the builds cache.')
+def flash_remote(wipe, reboot, streaming, tee):
     """Download and flash a version of Flo OS"""
 
+    if bundle.current is not None:
+        flash_bundled(wipe, reboot)
+        return
+
     check_aws_credentials()
 
     global s3
@@ -345,6 +571,17 @@ def flash_remote(wipe, reboot):
     # show available versions
     version = populate_and_select_os_versions()
 
+    if streaming and not check_for_local_build(version):
+        fastboot_ok = wait_for_fastboot_device()
+        if not fastboot_ok:
+            sys.exit(1)
+        success = flash_streamed_build(version, wipe, tee)
+        if success is not None:
+            if success and reboot:
+                fastboot("reboot")
+            return
+        logger.warn(f"No package published for {version}, downloading the build instead.")
+
     # Download Flo build
     if not check_for_local_build(version):
         download_flo_build(version)
@@ -354,15 +591,36 @@ def flash_remote(wipe, reboot):
         sys.exit(1)
 
     # Flash Flo build via fastboot
-    file_name = f"{CACHE_DIR}/{version}.zip"
+    file_name = local_build_path(version)
     success = flash_flo_build(file_name, wipe)
     if success and reboot:
         fastboot("reboot")
 
 
+def flash_bundled(wipe, reboot):
+    """flash remote for a --bundle, flashing the build straight from the bundle"""
+    check_platform_tools()
+
+    versions = bundle.current.builds()
+    if not versions:
+        logger.error(f"No Flo OS builds in {bundle.current.file_name}")
+        sys.exit(1)
+    version = select_os_version(versions)
+
+    fastboot_ok = wait_for_fastboot_device()
+    if not fastboot_ok:
+        sys.exit(1)
+
+    success = flash_flo_build(bundle.current.file_name, wipe, bundle.current.build_offset(version))
+    if success and reboot:
+        fastboot("reboot")
+
+
 @click.group()
 @click.version_option(version="", message=f"Flo OS flash utility : {VERSION}")
-def cli():
+@click.option('--bundle', '-b', 'bundle_file', envvar="FLO_BUNDLE", type=click.Path(exists=True),
+              help='Offline bundle to take platform tools and builds from, see ./bundle.')
+def cli(bundle_file):
     """Flo OS flash utility
 
     Important points:
@@ -378,14 +636,23 @@ def cli():
     2. For local builds, the zip file must contain all partition image files (.img) with the filename as the partition name.
 
     3. If you're using a beryllium (Xiaomi Poco F1) device, USB 2.0 port might cause a problem, be sure to use a USB Hub.
+
+    4. With --bundle, remote flashes a build from the bundle, without internet.
     """
-    pass
+    if bundle_file:
+        try:
+            bundle.use(bundle_file)
+        except package.PackageException as e:
+            logger.error(e.message)
+            sys.exit(1)
 
 
 cli.add_command(flash_remote)
 cli.add_command(flash_local)
 cli.add_command(factory_reset)
 cli.add_command(cleanup)
+cli.add_command(pack)
+cli.add_command(index)
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+VERSION = "v0.1.0"
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import platform
+import threading
+import subprocess
+import concurrent.futures as futures
+
+import click
+
+import logger
+
+PLATFORM = platform.uname().system.lower()
+PLATFORM_TOOLS_PATH = f"{os.getcwd()}/platform-tools"
+
+if PLATFORM == "windows":
+    ADB = f"{PLATFORM_TOOLS_PATH}\\adb.exe"
+else:
+    ADB = f"{PLATFORM_TOOLS_PATH}/adb"
+
+ADB_TCP_PORT = 5555
+PARALLEL = 32
+TIMEOUT = 30
+
+# fifos of the RPC server started by bootup.sh, see stub/server.sh.script
+RPC_IN = "/dev/socket/anx_in"
+RPC_OUT = "/dev/socket/anx_out"
+
+# adb's own errors when the connection is gone, as opposed to errors of the command on the device
+TRANSPORT_ERROR_PATTERN = re.compile(
+    r"(?:adb: )?(?:error: )?(?:device '[^']*' not found|device offline)|(?:adb: )?error: closed")
+
+
+class Result:
+    def __init__(self, host, ok, output, returncode=None, duration=0.0):
+        self.host = host
+        self.ok = ok
+        self.output = output
+        self.returncode = returncode
+        self.duration = duration
+
+    def to_dict(self):
+        return {
+            "host": self.host,
+            "ok": self.ok,
+            "returncode": self.returncode,
+            "duration": round(self.duration, 3),
+            "output": self.output,
+        }
+
+
+class AdbPool:
+    """Keeps one adb server connection per device and reuses it across commands
+
+    Arguments:
+        adb -- adb binary. Point it at a stand-in to test without devices.
+        server_port -- port of the adb server to use, None for the default
+        timeout -- seconds allowed per host, connecting and retrying included
+    """
+
+    def __init__(self, adb=ADB, server_port=None, timeout=TIMEOUT):
+        self.adb = adb
+        self.server_port = server_port
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connected = set()
+
+    def _cmd(self, *args):
+        cmd = [self.adb]
+        if self.server_port:
+            cmd += ["-P", str(self.server_port)]
+        return cmd + list(args)
+
+    def _run(self, deadline, *args):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(self._cmd(*args), self.timeout)
+        return subprocess.run(self._cmd(*args), capture_output=True, timeout=remaining)
+
+    def connect(self, host, force=False, deadline=None):
+        with self.lock:
+            if host in self.connected and not force:
+                return
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        ret = self._run(deadline, "connect", host)
+        output = ret.stdout.decode().strip()
+        # adb connect exits 0 even when it fails, the message tells
+        if ret.returncode != 0 or not output.startswith(("connected", "already connected")):
+            raise ConnectionError(output or ret.stderr.decode().strip())
+        with self.lock:
+            self.connected.add(host)
+
+    def run(self, host, *args):
+        """Runs adb -s host args, reconnecting once if the connection dropped
+
+        Only retried when adb failed before reaching the device, so a
+        command that ran and failed is never run twice. Everything shares
+        one deadline, raising subprocess.TimeoutExpired once it passed.
+        """
+        deadline = time.monotonic() + self.timeout
+        self.connect(host, deadline=deadline)
+        ret = self._run(deadline, "-s", host, *args)
+        error = ret.stderr.decode().strip()
+        if ret.returncode != 0 and not ret.stdout and TRANSPORT_ERROR_PATTERN.fullmatch(error):
+            self.connect(host, force=True, deadline=deadline)
+            ret = self._run(deadline, "-s", host, *args)
+        return ret
+
+
+def _timed(host, fn):
+    start = time.monotonic()
+    try:
+        result = fn()
+    except subprocess.TimeoutExpired:
+        result = Result(host, False, "timed out")
+    except ConnectionError as e:
+        result = Result(host, False, f"connection failed : {e}")
+    result.duration = time.monotonic() - start
+    return result
+
+
+def shell(pool, host, command):
+    def run():
+        ret = pool.run(host, "shell", command)
+        output = (ret.stdout + ret.stderr).decode().rstrip()
+        return Result(host, ret.returncode == 0, output, ret.returncode)
+    return _timed(host, run)
+
+
+def push(pool, host, local_file, remote_path):
+    def run():
+        ret = pool.run(host, "push", local_file, remote_path)
+        output = (ret.stdout + ret.stderr).decode().rstrip()
+        return Result(host, ret.returncode == 0, output, ret.returncode)
+    return _timed(host, run)
+
+
+def rpc(pool, host, request):
+    """Calls server.sh. Responses are "1;<message>" on success, "0;<error>" otherwise."""
+    # timeout on the device too, or a dead server leaves the shell blocked on the fifo
+    command = f"cat {RPC_OUT} & echo {shlex.quote(request)} > {RPC_IN}; wait"
+    command = f"timeout {pool.timeout} sh -c {shlex.quote(command)}"
+
+    def run():
+        ret = pool.run(host, "shell", command)
+        response = ret.stdout.decode().rstrip()
+        status, _, message = response.partition(";")
+        return Result(host, ret.returncode == 0 and status == "1", message or response, ret.returncode)
+    return _timed(host, run)
+
+
+def run_all(hosts, job, parallel=PARALLEL):
+    """Runs job(host) on every host, at most parallel at once, yielding results as they finish"""
+    with futures.ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="fleet") as executor:
+        pending = {executor.submit(job, host): host for host in hosts}
+        for future in futures.as_completed(pending):
+            yield future.result()
+
+
+def read_hosts(hosts_file, devices):
+    hosts = list(devices)
+    if hosts_file:
+        with open(hosts_file) as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if line:
+                    hosts.append(line)
+    # bare addresses use the port bootup.sh enables
+    hosts = [host if ":" in host else f"{host}:{ADB_TCP_PORT}" for host in hosts]
+    if not hosts:
+        logger.error("No devices given. Use --hosts and/or --device.")
+        sys.exit(1)
+    return list(dict.fromkeys(hosts))
+
+
+def report(results, as_json):
+    """Prints every result and a summary to stdout
+
+    Results are output, not log records, so they are never dropped by the
+    console rate limit however many devices there are.
+    """
+    ok = 0
+    failed = 0
+    start = time.monotonic()
+    for result in results:
+        if result.ok:
+            ok += 1
+        else:
+            failed += 1
+        if as_json:
+            click.echo(json.dumps(result.to_dict()))
+            continue
+        for line in result.output.splitlines() or [""]:
+            click.echo(click.style(f"[{result.host}] {line}", fg=None if result.ok else "red"))
+    summary = f"{ok} ok, {failed} failed in {time.monotonic() - start:.1f}s"
+    if as_json:
+        click.echo(json.dumps({"ok": ok, "failed": failed}), err=True)
+    else:
+        click.echo(click.style(summary, fg="red" if failed else "green"))
+    sys.exit(1 if failed else 0)
+
+
+def fleet_options(fn):
+    options = [
+        click.option('--hosts', '-H', 'hosts_file', type=click.Path(exists=True),
+                     help='File with one device address (host[:port]) per line.'),
+        click.option('--device', '-d', 'devices', multiple=True, help='Device address, can be repeated.'),
+        click.option('--parallel', '-j', default=PARALLEL, show_default=True, help='Devices worked on at once.'),
+        click.option('--timeout', '-t', default=TIMEOUT, show_default=True, help='Seconds allowed per device.'),
+        click.option('--adb', 'adb_path', default=ADB, envvar="FLO_ADB", help='adb binary to use.'),
+        click.option('--server-port', '-P', type=int, help='Port of the adb server to use.'),
+        click.option('--json', 'as_json', is_flag=True, help='Print one JSON object per device.'),
+    ]
+    for option in reversed(options):
+        fn = option(fn)
+    return fn
+
+
+@click.command(name="exec", context_settings={"allow_interspersed_args": False})
+@fleet_options
+@click.argument("command", nargs=-1, required=True, type=click.UNPROCESSED)
+def exec_command(hosts_file, devices, parallel, timeout, adb_path, server_port, as_json, command):
+    """Run a shell command on every device.
+
+    Options go before COMMAND, everything after it is passed to the device.
+    """
+    hosts = read_hosts(hosts_file, devices)
+    pool = AdbPool(adb_path, server_port, timeout)
+    command = " ".join(command)
+    report(run_all(hosts, lambda host: shell(pool, host, command), parallel), as_json)
+
+
+@click.command(name="push")
+@fleet_options
+@click.argument("local_file", type=click.Path(exists=True))
+@click.argument("remote_path")
+def push_file(hosts_file, devices, parallel, timeout, adb_path, server_port, as_json, local_file, remote_path):
+    """Push a file to every device."""
+    hosts = read_hosts(hosts_file, devices)
+    pool = AdbPool(adb_path, server_port, timeout)
+    report(run_all(hosts, lambda host: push(pool, host, local_file, remote_path), parallel), as_json)
+
+
+@click.command(name="rpc")
+@fleet_options
+@click.argument("request")
+def rpc_call(hosts_file, devices, parallel, timeout, adb_path, server_port, as_json, request):
+    """Call the on-device RPC server, e.g. GetFloOsVersion."""
+    hosts = read_hosts(hosts_file, devices)
+    pool = AdbPool(adb_path, server_port, timeout)
+    report(run_all(hosts, lambda host: rpc(pool, host, request), parallel), as_json)
+
+
+@click.group()
+@click.version_option(version="", message=f"Flo OS fleet utility : {VERSION}")
+def cli():
+    """Flo OS fleet utility
+
+    Runs commands on many Flo Edge devices over adb-over-TCP (port 5555,
+    enabled by bootup.sh). Each device is connected once and the
+    connection is reused, with at most --parallel devices in flight.
+    """
+    pass
+
+
+cli.add_command(exec_command)
+cli.add_command(push_file)
+cli.add_command(rpc_call)
+
+if __name__ == '__main__':
+    cli()
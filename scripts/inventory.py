@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+VERSION = "v0.1.0"
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import pathlib
+import platform
+import subprocess
+import concurrent.futures as futures
+
+import click
+
+import logger
+
+PLATFORM = platform.uname().system.lower()
+PLATFORM_TOOLS_PATH = f"{os.getcwd()}/platform-tools"
+
+if PLATFORM == "windows":
+    ADB = f"{PLATFORM_TOOLS_PATH}\\adb.exe"
+    FASTBOOT = f"{PLATFORM_TOOLS_PATH}\\fastboot.exe"
+else:
+    ADB = f"{PLATFORM_TOOLS_PATH}/adb"
+    FASTBOOT = f"{PLATFORM_TOOLS_PATH}/fastboot"
+
+# resolved, so ./inventory and the tools importing this module share one database
+DB_FILE = os.getenv("FLO_INVENTORY_DB", os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "inventory.db"))
+PROBE_TIMEOUT = 20
+PROBE_WORKERS = 16
+
+APK_PACKAGES = {
+    "anx": "com.flomobility.anx.headless",
+    "magisk": "com.topjohnwu.magisk",
+}
+
+# everything a probe needs, gathered by a single adb shell call
+PROBE_SCRIPT = "; ".join([
+    'echo "flo_os_version=$(getprop ro.lineage.version)"',
+    'echo "anx_owner=$(ls -dl /data/data/com.flomobility.anx.headless 2>/dev/null | awk \'{print $3}\')"',
+    'echo "has_su=$(test -f /system/xbin/su && echo 1 || echo 0)"',
+    'echo "has_rootfs=$(test -f /sdcard/linux.img && echo 1 || echo 0)"',
+] + [
+    f'echo "apk.{name}=$(dumpsys package {package} | grep -m1 versionName | cut -d= -f2)"'
+    for name, package in APK_PACKAGES.items()
+])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    serial TEXT PRIMARY KEY,
+    state TEXT,
+    usb_port TEXT,
+    flo_os_version TEXT,
+    build TEXT,
+    partition_hashes TEXT,
+    apk_versions TEXT,
+    rootfs_version TEXT,
+    facts TEXT,
+    last_flash REAL,
+    last_bootstrap REAL,
+    last_probe REAL
+);
+CREATE INDEX IF NOT EXISTS devices_flo_os_version ON devices (flo_os_version);
+CREATE INDEX IF NOT EXISTS devices_rootfs_version ON devices (rootfs_version);
+"""
+
+COLUMNS = ["serial", "state", "usb_port", "flo_os_version", "build", "partition_hashes",
+           "apk_versions", "rootfs_version", "facts", "last_flash", "last_bootstrap", "last_probe"]
+JSON_COLUMNS = {"partition_hashes", "apk_versions", "facts"}
+
+
+def connect(db_file=None):
+    db = sqlite3.connect(db_file or DB_FILE, timeout=10)
+    db.row_factory = sqlite3.Row
+    # lets the station's device threads write while queries read
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def update(serial, db_file=None, **fields):
+    """Inserts or updates the facts known about a device"""
+    for column in JSON_COLUMNS & fields.keys():
+        fields[column] = json.dumps(fields[column])
+    columns = ["serial"] + list(fields)
+    assignments = ", ".join(f"{column} = excluded.{column}" for column in fields)
+    db = connect(db_file)
+    try:
+        with db:
+            db.execute(
+                f"INSERT INTO devices ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (serial) DO UPDATE SET {assignments}",
+                [serial] + list(fields.values()))
+    finally:
+        db.close()
+
+
+def safe_update(serial, **fields):
+    """update() for provisioning paths. The inventory must never fail a device."""
+    if not serial:
+        return
+    try:
+        update(serial, **fields)
+    except sqlite3.Error as e:
+        logger.warn(f"Couldn't update device inventory : {e}")
+
+
+def record_flash(serial, build, partition_hashes):
+    safe_update(serial, build=build, partition_hashes=partition_hashes, last_flash=time.time())
+
+
+def record_bootstrap(serial, rootfs_version):
+    fields = {"last_bootstrap": time.time()}
+    if rootfs_version:
+        fields["rootfs_version"] = rootfs_version
+    safe_update(serial, **fields)
+
+
+def _row_to_dict(row):
+    device = dict(row)
+    for column in JSON_COLUMNS:
+        if device.get(column):
+            device[column] = json.loads(device[column])
+    return device
+
+
+def list_devices(db_file=None, **filters):
+    """Returns devices matching column=value filters"""
+    for column in filters:
+        if column not in COLUMNS:
+            raise ValueError(f"Unknown column {column}")
+    where = " AND ".join(f"{column} = ?" for column in filters)
+    db = connect(db_file)
+    try:
+        rows = db.execute(
+            "SELECT * FROM devices" + (f" WHERE {where}" if where else "") + " ORDER BY serial",
+            list(filters.values())).fetchall()
+    finally:
+        db.close()
+    return [_row_to_dict(row) for row in rows]
+
+
+def attached_devices(adb=ADB, fastboot=FASTBOOT):
+    """Returns {serial: (state, usb port)} from one adb and one fastboot listing"""
+    devices = {}
+    try:
+        ret = subprocess.run([adb, "devices", "-l"], capture_output=True, timeout=PROBE_TIMEOUT)
+        for line in ret.stdout.decode().splitlines()[1:]:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            usb_port = next((field.split(":", 1)[1] for field in fields[2:] if field.startswith("usb:")), None)
+            devices[fields[0]] = (fields[1], usb_port)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    try:
+        ret = subprocess.run([fastboot, "devices"], capture_output=True, timeout=PROBE_TIMEOUT)
+        for line in ret.stdout.decode().splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                devices[fields[0]] = (fields[1], None)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    return devices
+
+
+def probe_device(serial, adb=ADB):
+    """Reads a booted device's facts with one adb shell call"""
+    ret = subprocess.run([adb, "-s", serial, "shell", PROBE_SCRIPT],
+                         capture_output=True, timeout=PROBE_TIMEOUT)
+    values = {}
+    for line in ret.stdout.decode().splitlines():
+        key, _, value = line.strip().partition("=")
+        values[key] = value.strip()
+    return {
+        "flo_os_version": values.get("flo_os_version") or None,
+        "apk_versions": {name: values.get(f"apk.{name}") or None for name in APK_PACKAGES},
+        "facts": {
+            "anx_owner": values.get("anx_owner") or None,
+            "has_su": values.get("has_su") == "1",
+            "has_rootfs": values.get("has_rootfs") == "1",
+        },
+    }
+
+
+def probe(db_file=None, adb=ADB, fastboot=FASTBOOT):
+    """Refreshes the inventory for every attached device, probing them in parallel
+
+    Returns:
+        the serials that were refreshed
+    """
+    devices = attached_devices(adb, fastboot)
+
+    def refresh(serial):
+        state, usb_port = devices[serial]
+        fields = {"state": state, "last_probe": time.time()}
+        if usb_port:
+            fields["usb_port"] = usb_port
+        if state == "device":
+            try:
+                fields.update(probe_device(serial, adb))
+            except subprocess.TimeoutExpired:
+                logger.warn("Probe timed out.", tag=serial)
+        update(serial, db_file, **fields)
+
+    with futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        list(executor.map(refresh, devices))
+    return list(devices)
+
+
+def _echo_devices(devices, as_json):
+    if as_json:
+        click.echo(json.dumps(devices, indent=2))
+        return
+    for device in devices:
+        apks = ", ".join(f"{name} {version}" for name, version in (device["apk_versions"] or {}).items() if version)
+        click.echo(f"{device['serial']:<20} {device['state'] or '-':<10} "
+                   f"{device['flo_os_version'] or '-':<24} {device['rootfs_version'] or '-':<20} {apks}")
+
+
+@click.command(name="probe")
+@click.option('--json', 'as_json', is_flag=True, help='Print devices as JSON.')
+def probe_command(as_json):
+    """Refresh the inventory from every attached device."""
+    serials = probe()
+    logger.info(f"Probed {len(serials)} devices.")
+    _echo_devices([device for device in list_devices() if device["serial"] in serials], as_json)
+
+
+@click.command(name="list")
+@click.option('--version', '-v', 'flo_os_version', help='Only devices on this Flo OS version.')
+@click.option('--rootfs', '-r', 'rootfs_version', help='Only devices with this file system.')
+@click.option('--json', 'as_json', is_flag=True, help='Print devices as JSON.')
+def list_command(flo_os_version, rootfs_version, as_json):
+    """List known devices."""
+    filters = {}
+    if flo_os_version:
+        filters["flo_os_version"] = flo_os_version
+    if rootfs_version:
+        filters["rootfs_version"] = rootfs_version
+    _echo_devices(list_devices(**filters), as_json)
+
+
+@click.command(name="show")
+@click.argument("serial")
+def show_command(serial):
+    """Show everything known about a device."""
+    devices = list_devices(serial=serial)
+    if not devices:
+        logger.error(f"{serial} is not in the inventory.")
+        sys.exit(1)
+    click.echo(json.dumps(devices[0], indent=2))
+
+
+@click.command(name="sql")
+@click.argument("query")
+def sql_command(query):
+    """Run a read-only SQL query on the devices table."""
+    # as a URI, so ?, # or % in the path are escaped
+    db = sqlite3.connect(f"{pathlib.Path(os.path.abspath(DB_FILE)).as_uri()}?mode=ro", uri=True)
+    try:
+        cursor = db.execute(query)
+        columns = [column[0] for column in cursor.description or []]
+        for row in cursor:
+            click.echo(json.dumps(dict(zip(columns, row))))
+    except sqlite3.Error as e:
+        logger.error(f"Query failed : {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+@click.group()
+@click.version_option(version="", message=f"Flo OS device inventory : {VERSION}")
+def cli():
+    """Flo OS device inventory
+
+    Facts about every device seen by flash, bootstrap and station are kept
+    in a local SQLite database (FLO_INVENTORY_DB, defaults to inventory.db
+    in the repo), keyed by serial.
+    """
+    pass
+
+
+cli.add_command(probe_command)
+cli.add_command(list_command)
+cli.add_command(show_command)
+cli.add_command(sql_command)
+
+if __name__ == '__main__':
+    cli()
@@ -1,19 +1,139 @@
+import os
+import sys
+import json
 import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
 
 from termcolor import colored
 
+from utils import get_serial
+
+# Records are put on a queue by the caller and written to the console and a
+# JSON Lines file by a single background thread, so logging never waits on
+# a terminal or disk.
+LOG_DIR = os.getenv("FLO_LOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "logs"))
+LOG_FILE = os.path.join(LOG_DIR, "flo.jsonl")
+LOG_LEVEL = (os.getenv("FLO_LOG_LEVEL") or "DEBUG").upper()
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+# debug/info lines printed per second, warnings and errors are never dropped
+CONSOLE_RATE = 20
+CONSOLE_BURST = 50
+
+COLORS = {
+    logging.DEBUG: "white",
+    logging.INFO: "green",
+    logging.WARNING: "yellow",
+    logging.ERROR: "red",
+}
+
+_context = threading.local()
+
 def current_milli_time():
     return round(time.time() * 1000)
 
+def set_phase(phase):
+    """Tags the calling thread's log records with a provisioning phase"""
+    _context.phase = phase
+
+def get_phase():
+    return getattr(_context, "phase", None)
+
+
+class ConsoleHandler(logging.Handler):
+    """Prints records in the classic colored format, rate limiting debug/info"""
+
+    def __init__(self, rate=CONSOLE_RATE, burst=CONSOLE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.suppressed = 0
+
+    def _allow(self, record):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def emit(self, record):
+        if not self._allow(record):
+            self.suppressed += 1
+            return
+        if self.suppressed:
+            print(colored(f"[{current_milli_time()}] [-] ... {self.suppressed} messages not shown", "white"))
+            self.suppressed = 0
+        tag = record.tag
+        if record.serial:
+            tag = f"{record.serial}] [{tag}"
+        print(colored(f"[{round(record.created * 1000)}] [{tag}] {record.getMessage()}", COLORS[record.levelno]))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "serial": record.serial,
+            "phase": record.phase,
+            "tag": record.tag,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        })
+
+
+def _file_handler():
+    try:
+        os.makedirs(LOG_DIR, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS)
+    except OSError as e:
+        print(colored(f"[{current_milli_time()}] [-] Not writing logs to {LOG_FILE} : {e}", "yellow"), file=sys.stderr)
+        return None
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+_logger = logging.getLogger("flo")
+_logger.setLevel(LOG_LEVEL if LOG_LEVEL in LOG_LEVELS else "DEBUG")
+_logger.propagate = False
+_queue = queue.SimpleQueue()
+_logger.addHandler(logging.handlers.QueueHandler(_queue))
+
+_listener = logging.handlers.QueueListener(
+    _queue, *[h for h in (ConsoleHandler(), _file_handler()) if h is not None])
+_listener.start()
+# flush everything queued before the interpreter exits
+atexit.register(_listener.stop)
+
+
+def _log(level, msg, tag):
+    _logger.log(level, msg, extra={"tag": tag, "serial": get_serial(), "phase": get_phase()})
+
 def debug(msg, tag="-"):
-    print(colored(f"[{current_milli_time()}] [{tag}] {msg}", "white"))
+    _log(logging.DEBUG, msg, tag)
 
 def info(msg, tag="-"):
-    print(colored(f"[{current_milli_time()}] [{tag}] {msg}", "green"))
+    _log(logging.INFO, msg, tag)
 
 def warn(msg, tag="-"):
-    print(colored(f"[{current_milli_time()}] [{tag}] {msg}", "yellow"))
+    _log(logging.WARNING, msg, tag)
 
 def error(msg, tag="-"):
-    print(colored(f"[{current_milli_time()}] [{tag}] {msg}", "red"))
+    _log(logging.ERROR, msg, tag)
+
 
+if LOG_LEVEL not in LOG_LEVELS:
+    warn(f"Unknown FLO_LOG_LEVEL {LOG_LEVEL}, expected one of {', '.join(LOG_LEVELS).lower()}. Logging everything.")
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+# Host-side store for device logs
+#
+# Logs pulled from devices are split into boot sessions on the markers
+# bootup.sh writes at every boot, "-------------- <date> --------------",
+# and every line is stored once in SQLite with its device, session and time.
+# A full text index on the lines answers pattern queries without scanning.
+#
+# The device prunes whole sessions from the head of its logs, so a session
+# is known by its marker and its lines by their number in the session.
+# Pulling the same logs again only adds the lines that are new.
+
+VERSION = "v0.1.0"
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import calendar
+import platform
+import subprocess
+from datetime import datetime
+
+import click
+
+import logger
+from utils import get_serial
+
+PLATFORM = platform.uname().system.lower()
+PLATFORM_TOOLS_PATH = f"{os.getcwd()}/platform-tools"
+
+if PLATFORM == "windows":
+    ADB = f"{PLATFORM_TOOLS_PATH}\\adb.exe"
+else:
+    ADB = f"{PLATFORM_TOOLS_PATH}/adb"
+
+# resolved, so ./logstore and scripts/logstore.py use the same store next to the repo's logs/
+STORE_DIR = os.getenv("FLO_LOG_STORE", os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "device_logs"))
+DB_NAME = "logs.db"
+RAW_DIR_NAME = "raw"
+
+# device side locations, see stub/bootup.sh.script and stub/server.sh.script
+DEVICE_LOG_DIRS = ["/logs", "/data/local/mnt/root/.logs/system"]
+LOG_SOURCES = {
+    "bootup.log": "bootup",
+    "anx_server.log": "anx_server",
+    "misc.log": "misc",
+}
+LOGCAT_FILE_PATTERN = re.compile(r"^(\d\d)-(\d\d)-(\d\d):(\d\d):(\d\d):(\d\d)$")
+
+BOOT_MARKER_PATTERN = re.compile(r"^-------------- (.*) --------------$")
+# output of date, e.g. "Mon Jun  5 10:21:33 IST 2023"
+DATE_PATTERN = re.compile(r"\w{3} (\w{3}) +(\d{1,2}) (\d\d):(\d\d):(\d\d)(?: \S+)? (\d{4})")
+# logcat threadtime, e.g. "06-05 10:21:33.123"
+LOGCAT_TIME_PATTERN = re.compile(r"^(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\.(\d{3})")
+# server.sh colors its lines, sometimes as literal escapes
+COLOR_PATTERN = re.compile(r"(?:\x1b|\\033|\\e)\[[0-9;]*m")
+MONTHS = {month: index for index, month in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL,
+    source TEXT NOT NULL,
+    boot TEXT NOT NULL,
+    start REAL,
+    UNIQUE (serial, source, boot)
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions (id),
+    seq INTEGER NOT NULL,
+    ts REAL,
+    text TEXT NOT NULL,
+    UNIQUE (session, seq)
+);
+CREATE INDEX IF NOT EXISTS lines_ts ON lines (ts);
+CREATE INDEX IF NOT EXISTS sessions_serial_start ON sessions (serial, start);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5 (text, content='lines', content_rowid='id');
+"""
+
+
+def db_file():
+    return os.path.join(STORE_DIR, DB_NAME)
+
+
+def connect():
+    os.makedirs(STORE_DIR, exist_ok=True)
+    db = sqlite3.connect(db_file(), timeout=10)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def _timestamp(year, month, day, hour, minute, second, millis=0):
+    """Seconds since the epoch for a device local time, read as UTC"""
+    try:
+        return calendar.timegm((year, month, day, hour, minute, second)) + millis / 1000
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_date(text):
+    """Parses the output of date anywhere in text, None if there is none"""
+    match = DATE_PATTERN.search(text)
+    if not match or match.group(1) not in MONTHS:
+        return None
+    month, day, hour, minute, second, year = match.groups()
+    return _timestamp(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))
+
+
+def log_source(file_name):
+    """Returns (source, start time) for a pulled log file, source None if it is not a log"""
+    name = os.path.basename(file_name)
+    if name in LOG_SOURCES:
+        return LOG_SOURCES[name], None
+    match = LOGCAT_FILE_PATTERN.match(name)
+    if match:
+        day, month, year, hour, minute, second = (int(value) for value in match.groups())
+        return "logcat", _timestamp(2000 + year, month, day, hour, minute, second)
+    return None, None
+
+
+def split_sessions(lines, source, start=None):
+    """Splits a log into boot sessions
+
+    Lines before the first marker, and logs without markers, make up the
+    session named "". Logcat dumps are one session each, named by their start.
+
+    Yields:
+        (boot, start time, [(ts, text), ...]) per session
+    """
+    boot = ""
+    ts = start
+    session = []
+    year = time.gmtime(start).tm_year if start else None
+    for line in lines:
+        text = COLOR_PATTERN.sub("", line.rstrip("\r\n"))
+        marker = BOOT_MARKER_PATTERN.match(text) if source != "logcat" else None
+        if marker:
+            if session or boot:
+                yield boot, start, session
+            boot = marker.group(1)
+            start = ts = parse_date(boot)
+            session = []
+            continue
+        if source == "logcat":
+            match = LOGCAT_TIME_PATTERN.match(text)
+            if match and year:
+                month, day, hour, minute, second, millis = (int(value) for value in match.groups())
+                ts = _timestamp(year, month, day, hour, minute, second, millis) or ts
+        else:
+            ts = parse_date(text) or ts
+        session.append((ts, text))
+    if session or boot:
+        yield boot, start, session
+
+
+def ingest_file(db, serial, file_name):
+    """Adds the lines of a pulled log file that are not in the store yet
+
+    Returns:
+        number of lines added
+    """
+    source, start = log_source(file_name)
+    if source is None:
+        return 0
+    # a logcat dump is one session, named after its file
+    logcat_boot = os.path.basename(file_name) if source == "logcat" else None
+    added = 0
+    with open(file_name, errors="replace") as f:
+        for session_boot, session_start, session in split_sessions(f, source, start):
+            session_boot = logcat_boot or session_boot
+            db.execute(
+                "INSERT OR IGNORE INTO sessions (serial, source, boot, start) VALUES (?, ?, ?, ?)",
+                (serial, source, session_boot, session_start))
+            session_id, = db.execute(
+                "SELECT id FROM sessions WHERE serial = ? AND source = ? AND boot = ?",
+                (serial, source, session_boot)).fetchone()
+            stored, = db.execute("SELECT COUNT(*) FROM lines WHERE session = ?", (session_id,)).fetchone()
+            if stored >= len(session):
+                continue
+            last_id, = db.execute("SELECT IFNULL(MAX(id), 0) FROM lines").fetchone()
+            db.executemany(
+                "INSERT OR IGNORE INTO lines (session, seq, ts, text) VALUES (?, ?, ?, ?)",
+                ((session_id, seq, ts, text) for seq, (ts, text) in enumerate(session[stored:], stored)))
+            db.execute("INSERT INTO lines_fts (rowid, text) SELECT id, text FROM lines WHERE id > ?", (last_id,))
+            added += len(session) - stored
+    return added
+
+
+def ingest(serial, paths):
+    """Ingests log files and directories of them for a device
+
+    Returns:
+        number of lines added
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in sorted(names)]
+        else:
+            files.append(path)
+
+    db = connect()
+    added = 0
+    try:
+        with db:
+            for file_name in files:
+                added += ingest_file(db, serial, file_name)
+    finally:
+        db.close()
+    return added
+
+
+def pull(serial=None):
+    """Pulls a device's logs into the store's raw folder and ingests them
+
+    Returns:
+        number of lines added
+    """
+    serial = serial or get_serial()
+    if not serial:
+        ret = subprocess.run([ADB, "get-serialno"], capture_output=True)
+        serial = ret.stdout.decode().strip()
+    if not serial or serial == "unknown":
+        logger.error("No device found. Connect one or pass --device.")
+        sys.exit(1)
+    dest = os.path.join(STORE_DIR, RAW_DIR_NAME, serial)
+    os.makedirs(dest, exist_ok=True)
+    for log_dir in DEVICE_LOG_DIRS:
+        ret = subprocess.run([ADB, "-s", serial, "pull", log_dir, dest], capture_output=True)
+        if ret.returncode != 0:
+            logger.warn(f"Couldn't pull {log_dir} : {ret.stderr.decode().rstrip()}", tag=serial)
+    return ingest(serial, [dest])
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    try:
+        return calendar.timegm(datetime.fromisoformat(value).timetuple())
+    except ValueError:
+        raise click.BadParameter(f"{value} is not a time like 2023-06-05 or 2023-06-05T10:21")
+
+
+def query(serial=None, source=None, boot=None, since=None, until=None, pattern=None, limit=1000):
+    """Returns matching lines, oldest first
+
+    Arguments:
+        serial, source, boot -- restrict to a device, log and boot session
+        since, until -- seconds since the epoch, device local time
+        pattern -- full text query, e.g. 'error', '"linux.img"' or 'recover*'
+        limit -- maximum number of lines
+    """
+    conditions = []
+    params = []
+    tables = "lines JOIN sessions ON sessions.id = lines.session"
+    if pattern:
+        tables = "lines_fts JOIN lines ON lines.id = lines_fts.rowid JOIN sessions ON sessions.id = lines.session"
+        conditions.append("lines_fts MATCH ?")
+        params.append(pattern)
+    for column, value in (("sessions.serial", serial), ("sessions.source", source), ("sessions.boot", boot)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if since is not None:
+        conditions.append("lines.ts >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("lines.ts < ?")
+        params.append(until)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    db = connect()
+    try:
+        rows = db.execute(
+            f"SELECT sessions.serial, sessions.source, sessions.boot, lines.ts, lines.text FROM {tables}{where} "
+            f"ORDER BY lines.ts, lines.session, lines.seq LIMIT ?", params + [limit]).fetchall()
+    finally:
+        db.close()
+    return [dict(row) for row in rows]
+
+
+def sessions(serial=None):
+    db = connect()
+    try:
+        rows = db.execute(
+            "SELECT sessions.serial, sessions.source, sessions.boot, sessions.start, COUNT(lines.id) AS lines "
+            "FROM sessions LEFT JOIN lines ON lines.session = sessions.id "
+            + ("WHERE sessions.serial = ? " if serial else "")
+            + "GROUP BY sessions.id ORDER BY sessions.serial, sessions.start",
+            [serial] if serial else []).fetchall()
+    finally:
+        db.close()
+    return [dict(row) for row in rows]
+
+
+def _format_ts(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts)) if ts is not None else "-"
+
+
+@click.command(name="pull")
+@click.option('--device', '-d', 'devices', multiple=True, help='Device serial, can be repeated. Defaults to the connected one.')
+def pull_logs(devices):
+    """Pull logs from devices and ingest them."""
+    for serial in devices or [None]:
+        logger.info("Pulling logs ...", tag=serial or "-")
+        added = pull(serial)
+        logger.info(f"Done. {added} new lines.", tag=serial or "-")
+
+
+@click.command(name="ingest")
+@click.argument("serial")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+def ingest_logs(serial, paths):
+    """Ingest log files or folders already pulled from device SERIAL."""
+    logger.info(f"Ingesting logs of {serial} ...")
+    added = ingest(serial, paths)
+    logger.info(f"Done. {added} new lines.")
+
+
+@click.command(name="query")
+@click.argument("pattern", required=False)
+@click.option('--device', '-d', 'serial', help='Device serial.')
+@click.option('--source', '-s', type=click.Choice(sorted(set(LOG_SOURCES.values())) + ["logcat"]), help='Log to search.')
+@click.option('--boot', '-b', help='Boot session, as its marker date or logcat file name.')
+@click.option('--since', help='Lines at or after this device time, e.g. 2023-06-05T10:00.')
+@click.option('--until', help='Lines before this device time.')
+@click.option('--limit', '-n', default=1000, show_default=True, help='Maximum number of lines.')
+@click.option('--json', 'as_json', is_flag=True, help='Print one JSON object per line.')
+def query_logs(pattern, serial, source, boot, since, until, limit, as_json):
+    """Search stored logs.
+
+    PATTERN is a full text query: words, "quoted phrases", prefix* and
+    AND / OR / NOT. Without it every line in range is printed.
+    """
+    try:
+        rows = query(serial, source, boot, _parse_time(since), _parse_time(until), pattern, limit)
+    except sqlite3.OperationalError as e:
+        logger.error(f"Bad query : {e}")
+        sys.exit(1)
+    for row in rows:
+        if as_json:
+            click.echo(json.dumps(row))
+        else:
+            click.echo(f"{row['serial']} {row['source']:<10} {_format_ts(row['ts'])}  {row['text']}")
+
+
+@click.command(name="sessions")
+@click.option('--device', '-d', 'serial', help='Device serial.')
+def list_sessions(serial):
+    """List stored boot sessions."""
+    for session in sessions(serial):
+        click.echo(f"{session['serial']} {session['source']:<10} {_format_ts(session['start'])} "
+                   f"{session['lines']:>7} lines  {session['boot'] or '(before first boot marker)'}")
+
+
+@click.group()
+@click.version_option(version="", message=f"Flo OS log store : {VERSION}")
+def cli():
+    """Flo OS log store
+
+    Keeps device logs pulled from many devices in one indexed store
+    (FLO_LOG_STORE, defaults to device_logs/ in the repo), split into boot
+    sessions, for queries by device, session, time and pattern.
+    """
+    pass
+
+
+cli.add_command(pull_logs)
+cli.add_command(ingest_logs)
+cli.add_command(query_logs)
+cli.add_command(list_sessions)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,274 @@
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+# Flo OS release package (.flopkg)
+#
+#   magic (8 bytes) | index length (uint64 LE) | JSON index | padding | data
+#
+# Each entry's data starts on an ALIGNMENT boundary. Stored entries are the
+# raw image bytes, so they can be memory mapped or cloned out of the package
+# without decompression. zlib entries are split into CHUNK_SIZE chunks that
+# are compressed on their own, so any chunk can be read without the others.
+
+import os
+import re
+import json
+import mmap
+import zlib
+import struct
+import hashlib
+import zipfile
+
+MAGIC = b"FLOPKG\x00\x01"
+HEADER = struct.Struct("<8sQ")
+ALIGNMENT = 4096
+CHUNK_SIZE = 4 * 1024 * 1024
+COPY_SIZE = 1024 * 1024
+FORMAT_VERSION = 1
+EXTENSION = ".flopkg"
+
+SPARSE_MAGIC = 0xED26FF3A
+IMAGE_FILE_PATTERN = re.compile(r"(\w+)\.img$")
+
+
+class PackageException(Exception):
+    def __init__(self, message=""):
+        self.message = message
+        super().__init__(message)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_package(file_name, offset=0):
+    with open(file_name, "rb") as f:
+        f.seek(offset)
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _is_sparse(head):
+    return len(head) >= 4 and struct.unpack("<I", head[:4])[0] == SPARSE_MAGIC
+
+
+def _copy_range(src, dst, offset, length):
+    """Copies length bytes of src from offset to the current position of dst
+
+    Uses copy_file_range where available, which lets the kernel share the
+    blocks on reflink capable filesystems instead of copying them.
+    """
+    src.flush()
+    dst.flush()
+    if hasattr(os, "copy_file_range"):
+        dst_offset = dst.tell()
+        try:
+            while length > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset, dst_offset)
+                if copied == 0:
+                    break
+                offset += copied
+                dst_offset += copied
+                length -= copied
+        except OSError:
+            pass
+        # copy_file_range leaves the file positions alone, carry on after what it copied
+        dst.seek(dst_offset)
+        if length == 0:
+            return
+    src.seek(offset)
+    while length > 0:
+        data = src.read(min(COPY_SIZE, length))
+        if not data:
+            raise PackageException("Unexpected end of package")
+        dst.write(data)
+        length -= len(data)
+
+
+class Package:
+    """Read access to a .flopkg, optionally embedded at offset in a larger file"""
+
+    def __init__(self, file_name, offset=0):
+        self.file_name = file_name
+        self.offset = offset
+        with open(file_name, "rb") as f:
+            f.seek(offset)
+            magic, index_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise PackageException(f"{file_name} is not a Flo OS package")
+            self.index = json.loads(f.read(index_length))
+        if self.index.get("format") != FORMAT_VERSION:
+            raise PackageException(f"Unsupported package format {self.index.get('format')}")
+        self.entries = {entry["name"]: entry for entry in self.index["entries"]}
+        self._file = None
+        self._map = None
+
+    @property
+    def version(self):
+        return self.index.get("version")
+
+    @property
+    def kind(self):
+        return self.index.get("kind", "package")
+
+    @property
+    def flash_order(self):
+        return self.index["flash_order"]
+
+    def _mapped(self):
+        if self._map is None:
+            self._file = open(self.file_name, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def chunks(self, name):
+        """Yields the entry's bytes as memoryviews, straight from the mapping when stored"""
+        entry = self.entries[name]
+        data = memoryview(self._mapped())
+        start = self.offset + entry["offset"]
+        if entry["compression"] == "none":
+            for pos in range(0, entry["size"], CHUNK_SIZE):
+                yield data[start + pos:start + min(entry["size"], pos + CHUNK_SIZE)]
+            return
+        for length in entry["chunks"]:
+            yield memoryview(zlib.decompress(data[start:start + length]))
+            start += length
+
+    def verify(self, name):
+        digest = hashlib.sha256()
+        for chunk in self.chunks(name):
+            digest.update(chunk)
+        return digest.hexdigest() == self.entries[name]["sha256"]
+
+    def extract(self, name, dest):
+        """Writes an entry to dest. Stored entries are copied in the kernel."""
+        entry = self.entries[name]
+        with open(dest, "wb") as out:
+            if entry["compression"] == "none":
+                with open(self.file_name, "rb") as src:
+                    _copy_range(src, out, self.offset + entry["offset"], entry["size"])
+            else:
+                for chunk in self.chunks(name):
+                    out.write(chunk)
+
+
+def _stream_entry(reader, out, compression):
+    """Writes reader to out, returns (size, sha256, sparse, chunk lengths)"""
+    digest = hashlib.sha256()
+    size = 0
+    sparse = False
+    chunk_lengths = []
+    while True:
+        data = reader.read(CHUNK_SIZE)
+        if not data:
+            break
+        if size == 0:
+            sparse = _is_sparse(data)
+        digest.update(data)
+        size += len(data)
+        if compression == "zlib":
+            data = zlib.compress(data, 1)
+            chunk_lengths.append(len(data))
+        out.write(data)
+    return size, digest.hexdigest(), sparse, chunk_lengths
+
+
+def _open_member(source, info):
+    # the member keeps the zip open until it is closed itself
+    with zipfile.ZipFile(source) as archive:
+        return archive.open(info)
+
+
+def list_images(source):
+    """Returns (partition, opener) pairs for the .img files in a zip or directory"""
+    images = []
+    if os.path.isdir(source):
+        for file in sorted(os.listdir(source)):
+            match = IMAGE_FILE_PATTERN.match(file)
+            if match:
+                path = os.path.join(source, file)
+                images.append((match.group(1), lambda path=path: open(path, "rb")))
+    else:
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                match = IMAGE_FILE_PATTERN.match(os.path.basename(info.filename))
+                if match:
+                    images.append((match.group(1), lambda info=info: _open_member(source, info)))
+    return images
+
+
+def create(output, images, version=None, flash_order=None, compression="none", kind="package"):
+    """Writes a package
+
+    Arguments:
+        output -- path of the .flopkg to create
+        images -- (partition, opener) pairs, opener returns a readable file
+        version -- Flo OS version recorded in the index
+        flash_order -- partition names in flashing order, defaults to image order
+        compression -- "none" to store images, "zlib" to chunk-compress them
+        kind -- "package" for a Flo OS build, "bundle" for an offline bundle
+
+    Returns:
+        the index
+    """
+    if compression not in ("none", "zlib"):
+        raise PackageException(f"Unknown compression {compression}")
+    names = [name for name, _ in images]
+    flash_order = flash_order or names
+    missing = set(flash_order) - set(names)
+    if missing:
+        raise PackageException(f"No image for partitions : {', '.join(sorted(missing))}")
+
+    # leave room for the index, it is written once the data offsets are known
+    reserved = 64 * 1024 + sum(32 * 1024 + 16 for _ in images)
+    entries = []
+    with open(output, "wb") as out:
+        offset = _align(HEADER.size + reserved)
+        for name, opener in images:
+            out.seek(offset)
+            with opener() as reader:
+                size, sha256, sparse, chunk_lengths = _stream_entry(reader, out, compression)
+            entry = {
+                "name": name,
+                "offset": offset,
+                "size": size,
+                "sha256": sha256,
+                "sparse": sparse,
+                "compression": compression,
+            }
+            if compression != "none":
+                entry["chunk_size"] = CHUNK_SIZE
+                entry["chunks"] = chunk_lengths
+            entries.append(entry)
+            offset = _align(out.tell())
+        out.truncate(offset)
+
+        index = {
+            "format": FORMAT_VERSION,
+            "kind": kind,
+            "version": version,
+            "flash_order": flash_order,
+            "entries": entries,
+        }
+        index_data = json.dumps(index).encode()
+        if len(index_data) > reserved:
+            raise PackageException("Package index does not fit in its header")
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, len(index_data)))
+        out.write(index_data)
+    return index
@@ -0,0 +1,188 @@
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+import time
+import threading
+import contextlib
+
+import alive_progress as alive
+
+# samples (and bar redraws) per second. Transfers only add to a counter, all
+# rate math and rendering happens on the sampler thread.
+REFRESH_RATE = 4
+# weight of the newest sample in the smoothed rate
+SMOOTHING = 0.2
+
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(count) < 1024:
+            return f"{count:.1f}{unit}"
+        count /= 1024
+    return f"{count:.1f}TB"
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "-:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class Transfer:
+    """One download, push or flash. update() is safe to call from any thread."""
+
+    def __init__(self, name, total=None):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.rate = 0.0
+        self.smoothed_rate = 0.0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._last_done = 0
+
+    def update(self, count):
+        with self._lock:
+            self.done += count
+
+    def set(self, done):
+        with self._lock:
+            self.done = done
+
+    def eta(self):
+        if not self.total or not self.smoothed_rate:
+            return None
+        return max(0, self.total - self.done) / self.smoothed_rate
+
+
+class TransferMeter:
+    """Aggregates concurrent transfers into totals, rates and ETAs"""
+
+    def __init__(self, refresh_rate=REFRESH_RATE, smoothing=SMOOTHING):
+        self.refresh_rate = refresh_rate
+        self.smoothing = smoothing
+        # set to False when no terminal is watching, e.g. on a station
+        self.display = True
+        self.lock = threading.Lock()
+        self.active = []
+        self.completed_bytes = 0
+        self.completed_count = 0
+        self.rate = 0.0
+        self.smoothed_rate = 0.0
+        self._bars = {}
+        self._last_total = 0
+        self._last_sample = time.monotonic()
+        self._sampler = None
+
+    def start(self, name, total=None):
+        transfer = Transfer(name, total)
+        with self.lock:
+            self.active.append(transfer)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, name="progress", daemon=True)
+                self._sampler.start()
+        return transfer
+
+    def finish(self, transfer):
+        with self.lock:
+            self.active.remove(transfer)
+            self.completed_bytes += transfer.done
+            self.completed_count += 1
+
+    @contextlib.contextmanager
+    def track(self, name, total=None):
+        """Context manager yielding a Transfer, drawn as a bar when display is on
+
+        Only one bar is drawn at a time. Transfers that start while it is
+        open are summed up in its text instead.
+        """
+        transfer = self.start(name, total)
+        try:
+            with self.lock:
+                show_bar = self.display and not self._bars
+            if not show_bar:
+                yield transfer
+                return
+            with alive.alive_bar(manual=True, title=name) as bar:
+                with self.lock:
+                    self._bars[transfer] = bar
+                try:
+                    yield transfer
+                finally:
+                    # the sampler must not touch the bar once it is closed
+                    with self.lock:
+                        self._bars.pop(transfer)
+                        self._draw(transfer, bar)
+        finally:
+            self.finish(transfer)
+
+    def _draw(self, transfer, bar):
+        if transfer.total:
+            bar(min(1.0, transfer.done / transfer.total))
+        text = (f"{format_bytes(transfer.done)} "
+                f"{format_bytes(transfer.smoothed_rate)}/s "
+                f"ETA {format_eta(transfer.eta())}")
+        if len(self.active) > 1:
+            text += f" (+{len(self.active) - 1} more, {format_bytes(self.smoothed_rate)}/s total)"
+        bar.text = text
+
+    def sample(self):
+        """Updates instantaneous and smoothed rates, overall and per transfer"""
+        now = time.monotonic()
+        with self.lock:
+            active = list(self.active)
+            total = self.completed_bytes + sum(t.done for t in active)
+            elapsed = now - self._last_sample
+            if elapsed <= 0:
+                return
+            self.rate = (total - self._last_total) / elapsed
+            self.smoothed_rate += self.smoothing * (self.rate - self.smoothed_rate)
+            self._last_total = total
+            self._last_sample = now
+
+        for transfer in active:
+            done = transfer.done
+            transfer.rate = (done - transfer._last_done) / elapsed
+            if transfer.smoothed_rate == 0:
+                transfer.smoothed_rate = transfer.rate
+            else:
+                transfer.smoothed_rate += self.smoothing * (transfer.rate - transfer.smoothed_rate)
+            transfer._last_done = done
+
+        with self.lock:
+            for transfer, bar in self._bars.items():
+                self._draw(transfer, bar)
+
+    def snapshot(self):
+        """Returns aggregate totals and rates as a dict"""
+        with self.lock:
+            active = list(self.active)
+            done = self.completed_bytes + sum(t.done for t in active)
+            remaining = sum(max(0, t.total - t.done) for t in active if t.total)
+            return {
+                "bytes": done,
+                "bytes_remaining": remaining,
+                "rate": round(self.rate),
+                "smoothed_rate": round(self.smoothed_rate),
+                "eta": round(remaining / self.smoothed_rate, 1) if self.smoothed_rate else None,
+                "active": len(active),
+                "completed": self.completed_count,
+            }
+
+    def _run(self):
+        while True:
+            time.sleep(1 / self.refresh_rate)
+            self.sample()
+
+
+# shared by every download, push and flash in the process
+meter = TransferMeter()
+track = meter.track
@@ -0,0 +1,240 @@
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+import logger
+import progress
+
+DEFAULT_TARGET_PATH = "/sdcard/linux.img"
+BLOCK_SIZE = 4096
+# holes smaller than this are pushed as zeros instead of opening a new stream
+MIN_HOLE_SIZE = 1024 * 1024
+PUSH_CHUNK_SIZE = 1024 * 1024
+# next to a clean copy, how bootup.sh rebuilds the image from it, see save_clean_copy
+EXTENTS_SUFFIX = ".extents"
+
+CONFIG_LINE_PATTERN = re.compile(r'^\s*([A-Z_][A-Z0-9_]*)="?(.*?)"?\s*$')
+
+
+def read_config(config_file):
+    """Parses a linuxdeploy .conf file into a dict"""
+    config = {}
+    with open(config_file) as f:
+        for line in f:
+            match = CONFIG_LINE_PATTERN.match(line)
+            if match:
+                config[match.group(1)] = match.group(2)
+    return config
+
+
+def target_path(config):
+    path = config.get("TARGET_PATH", "")
+    if not path.startswith("/") or "$" in path:
+        return DEFAULT_TARGET_PATH
+    return path
+
+
+def _cache_stamp(tarball, config_file):
+    stamp = []
+    for path in (tarball, config_file):
+        st = os.stat(path)
+        stamp.append(f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}")
+    return "\n".join(stamp)
+
+
+def _disk_usage_mb(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            total += max(st.st_size, st.st_blocks * 512)
+    return total // (1024 * 1024)
+
+
+def _fakeroot(state_file, *args):
+    if os.geteuid() == 0:
+        return []
+    if shutil.which("fakeroot") is None:
+        logger.error("fakeroot is required to build the rootfs image as a non-root user.")
+        raise SystemExit(1)
+    return ["fakeroot", *args, state_file, "--"]
+
+
+def build_image(tarball, config_file, image):
+    """Builds an ext4 linux.img from a rootfs tarball on the host
+
+    Arguments:
+        tarball -- a -rootfs.tar.gz file
+        config_file -- the linuxdeploy .conf for the file system
+        image -- path of the image to create
+
+    Returns:
+        True if the image was (re)built, False if the cached one was reused
+    """
+    stamp = _cache_stamp(tarball, config_file)
+    stamp_file = f"{image}.stamp"
+    if os.path.isfile(image) and os.path.isfile(stamp_file):
+        with open(stamp_file) as f:
+            if f.read() == stamp:
+                logger.info("Using cached rootfs image.")
+                return False
+
+    if shutil.which("mke2fs") is None:
+        logger.error("mke2fs not found. Install e2fsprogs to build images on the host.")
+        raise SystemExit(1)
+
+    config = read_config(config_file)
+    os.makedirs(os.path.dirname(os.path.abspath(image)), exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(image))) as work_dir:
+        staging_dir = os.path.join(work_dir, "rootfs")
+        state_file = os.path.join(work_dir, "fakeroot.state")
+        os.mkdir(staging_dir)
+
+        logger.info(f"Extracting {os.path.basename(tarball)} ...")
+        ret = subprocess.run(
+            _fakeroot(state_file, "-s") +
+            ["tar", "--numeric-owner", "-xpzf", tarball, "-C", staging_dir])
+        if ret.returncode != 0:
+            logger.error(f"Error in extracting {tarball}")
+            raise SystemExit(ret.returncode)
+
+        size_mb = int(config.get("DISK_SIZE", "0") or 0)
+        if size_mb <= 0:
+            # leave headroom for the journal, metadata and first boot
+            size_mb = _disk_usage_mb(staging_dir) * 5 // 4 + 512
+
+        logger.info(f"Creating {size_mb}MB ext4 image ...")
+        tmp_image = f"{image}.tmp"
+        if os.path.exists(tmp_image):
+            os.remove(tmp_image)
+        ret = subprocess.run(
+            _fakeroot(state_file, "-i") +
+            ["mke2fs", "-q", "-F", "-t", "ext4", "-b", str(BLOCK_SIZE),
+             "-E", "root_owner=0:0", "-d", staging_dir, tmp_image, f"{size_mb}M"])
+        if ret.returncode != 0:
+            logger.error("Error in creating rootfs image")
+            raise SystemExit(ret.returncode)
+
+    os.replace(tmp_image, image)
+    with open(stamp_file, "w") as f:
+        f.write(stamp)
+    logger.info("Done.")
+    return True
+
+
+def data_extents(file_name):
+    """Returns the (offset, length) ranges of a file that hold data
+
+    Holes are skipped where the host filesystem supports SEEK_DATA, and
+    ranges closer than MIN_HOLE_SIZE are merged.
+    """
+    size = os.path.getsize(file_name)
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+
+    extents = []
+    with open(file_name, "rb") as f:
+        fd = f.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # no more data past offset
+                break
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            start -= start % BLOCK_SIZE
+            if extents and start - (extents[-1][0] + extents[-1][1]) < MIN_HOLE_SIZE:
+                extents[-1] = (extents[-1][0], end - extents[-1][0])
+            else:
+                extents.append((start, end - start))
+            offset = end
+    return extents
+
+
+def push_sparse(adb_cmd, file_name, remote_path):
+    """Pushes a sparse file to the device, transferring only its data ranges
+
+    Arguments:
+        adb_cmd -- the adb invocation as a list, e.g. [ADB] or [ADB, "-s", serial]
+        file_name -- local sparse file
+        remote_path -- destination on the device
+
+    Returns:
+        the (offset, length) ranges that were pushed
+    """
+    size = os.path.getsize(file_name)
+    extents = data_extents(file_name)
+    data_size = sum(length for _, length in extents)
+    logger.info(
+        f"Pushing {data_size // (1024 * 1024)}MB of data "
+        f"({size // (1024 * 1024)}MB image, {len(extents)} ranges) ...")
+
+    ret = subprocess.run(
+        adb_cmd + ["shell", f"rm -f {remote_path} && truncate -s {size} {remote_path}"],
+        stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+        logger.error(f"Error in creating {remote_path} : {ret.stderr.decode().rstrip()}")
+        raise SystemExit(ret.returncode)
+
+    with open(file_name, "rb") as f, progress.track(os.path.basename(file_name), data_size) as transfer:
+        for offset, length in extents:
+            proc = subprocess.Popen(
+                adb_cmd + ["exec-in",
+                           f"dd of={remote_path} bs={BLOCK_SIZE} seek={offset // BLOCK_SIZE} conv=notrunc 2>/dev/null"],
+                stdin=subprocess.PIPE)
+            f.seek(offset)
+            remaining = length
+            try:
+                while remaining > 0:
+                    data = f.read(min(PUSH_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    remaining -= len(data)
+                    transfer.update(len(data))
+            finally:
+                proc.stdin.close()
+            if proc.wait() != 0:
+                logger.error(f"Error in pushing {file_name} at offset {offset}")
+                raise SystemExit(proc.returncode)
+    logger.info("Done.")
+    return extents
+
+
+def save_clean_copy(adb_cmd, remote_path, copy_path, size, extents):
+    """Copies an image pushed with push_sparse to copy_path on the device, keeping its holes
+
+    The extents are written to copy_path + EXTENTS_SUFFIX, after a line with
+    the image size and remote_path, for bootup.sh to restore the image
+    from the copy during recovery.
+
+    Returns:
+        False if the copy couldn't be made, it is removed then
+    """
+    extents_path = f"{copy_path}{EXTENTS_SUFFIX}"
+    lines = [f"{size} {remote_path}"] + [
+        f"{offset // BLOCK_SIZE} {(length + BLOCK_SIZE - 1) // BLOCK_SIZE}" for offset, length in extents]
+    ret = subprocess.run(adb_cmd + ["exec-in", f"cat > {shlex.quote(extents_path)}"],
+                         input="\n".join(lines).encode() + b"\n", stderr=subprocess.PIPE)
+    if ret.returncode == 0:
+        # the same loop as restore_image in bootup.sh, the other way around
+        copy = (f"{{ read size target; rm -f {copy_path} && truncate -s $size {copy_path} && "
+                f"while read start count; do dd if={remote_path} of={copy_path} bs={BLOCK_SIZE} "
+                f"skip=$start seek=$start count=$count conv=notrunc 2>/dev/null || exit 1; done; }} < {extents_path}")
+        ret = subprocess.run(adb_cmd + ["shell", copy], stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+        logger.warn(f"Couldn't keep a copy of {remote_path} for recovery : {ret.stderr.decode().rstrip()}")
+        subprocess.run(adb_cmd + ["shell", f"rm -f {copy_path} {extents_path}"])
+        return False
+    return True
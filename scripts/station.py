@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+VERSION = "v0.1.0"
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import boto3
+
+import logger
+import progress
+import flash
+import bootstrap
+import rootfs
+from utils import set_serial
+
+BOOT_TIMEOUT = 180
+# a provisioned device is forgotten once unplugged for this long. It has to
+# outlast the reboots in the middle of a run.
+FORGET_AFTER = 120
+
+
+class StationMetrics:
+    """Thread-safe counters exposed on the status endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.in_flight = {}
+        self.phases = {}
+        self.completed = 0
+        self.failures = {}
+
+    def device_started(self, serial):
+        with self.lock:
+            self.in_flight[serial] = {"phase": "starting", "since": time.time()}
+
+    def device_finished(self, serial, failed_phase=None):
+        with self.lock:
+            self.in_flight.pop(serial, None)
+            if failed_phase is None:
+                self.completed += 1
+            else:
+                self.failures[failed_phase] = self.failures.get(failed_phase, 0) + 1
+
+    @contextlib.contextmanager
+    def phase(self, serial, name):
+        with self.lock:
+            self.in_flight[serial] = {"phase": name, "since": time.time()}
+        logger.set_phase(name)
+        start = time.monotonic()
+        outcome = "failed"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                stats = self.phases.setdefault((name, outcome), {"count": 0, "total": 0.0, "max": 0.0})
+                stats["count"] += 1
+                stats["total"] += duration
+                stats["max"] = max(stats["max"], duration)
+
+    def status(self):
+        with self.lock:
+            now = time.time()
+            return {
+                "uptime": round(now - self.started, 1),
+                "in_flight": {
+                    serial: {"phase": info["phase"], "elapsed": round(now - info["since"], 1)}
+                    for serial, info in self.in_flight.items()},
+                "completed": self.completed,
+                "failures": dict(self.failures),
+                "transfers": progress.meter.snapshot(),
+                "phases": [
+                    {
+                        "phase": name,
+                        "outcome": outcome,
+                        "count": stats["count"],
+                        "avg": round(stats["total"] / stats["count"], 2),
+                        "max": round(stats["max"], 2)}
+                    for (name, outcome), stats in sorted(self.phases.items())],
+            }
+
+    def prometheus(self):
+        status = self.status()
+        lines = [
+            f"flo_station_uptime_seconds {status['uptime']}",
+            f"flo_station_devices_in_flight {len(status['in_flight'])}",
+            f"flo_station_devices_completed_total {status['completed']}",
+            f"flo_station_bytes_transferred_total {status['transfers']['bytes']}",
+            f"flo_station_transfer_rate_bytes {status['transfers']['rate']}",
+            f"flo_station_transfer_rate_smoothed_bytes {status['transfers']['smoothed_rate']}",
+            f"flo_station_transfers_active {status['transfers']['active']}",
+        ]
+        for phase, count in status["failures"].items():
+            lines.append(f'flo_station_failures_total{{phase="{phase}"}} {count}')
+        for stats in status["phases"]:
+            labels = f'phase="{stats["phase"]}",outcome="{stats["outcome"]}"'
+            lines.append(f'flo_station_phase_seconds_count{{{labels}}} {stats["count"]}')
+            lines.append(f'flo_station_phase_seconds_avg{{{labels}}} {stats["avg"]}')
+            lines.append(f'flo_station_phase_seconds_max{{{labels}}} {stats["max"]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = StationMetrics()
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/status":
+            body = json.dumps(metrics.status(), indent=2).encode()
+            content_type = "application/json"
+        elif self.path == "/metrics":
+            body = metrics.prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_profile(profile_file):
+    """Reads a station profile
+
+    Example:
+        {
+            "flash": {"version": "flo-os-v1.0.0", "wipe": true},
+            "bootstrap": {"file_system": "flo-linux", "setup_ssh": true,
+                          "secure_adb": true, "host_image": true}
+        }
+    """
+    with open(profile_file) as f:
+        profile = json.load(f)
+    if "flash" not in profile and "bootstrap" not in profile:
+        logger.error("Profile must have a flash and/or bootstrap section.")
+        sys.exit(1)
+    return profile
+
+
+def warm_up(profile):
+    """Creates the S3 client, platform tools, adb server and every artifact once"""
+    flash.check_aws_credentials()
+    s3 = boto3.client(
+        's3',
+        aws_access_key_id=flash.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=flash.AWS_SECRET_ACCESS_KEY,
+        region_name=flash.AWS_S3_REGION_NAME)
+    flash.s3 = s3
+    bootstrap.s3 = s3
+    bootstrap.shared_s3 = True
+
+    flash.check_platform_tools()
+    subprocess.run([flash.ADB, "start-server"])
+
+    if "flash" in profile:
+        version = profile["flash"]["version"]
+        os.makedirs(flash.CACHE_DIR, exist_ok=True)
+        if not flash.check_for_local_build(version):
+            flash.download_flo_build(version)
+
+    if "bootstrap" in profile:
+        options = profile["bootstrap"]
+        file_system_name = options.get("file_system")
+        bootstrap.prepare_host()
+        bootstrap.download_setup_files(
+            file_system_name, options.get("setup_ssh", False), options.get("secure_adb", False))
+        bootstrap.write_boot_up_scripts()
+        if file_system_name and options.get("host_image", False):
+            config_file = f"{bootstrap.LOCAL_SETUP_DIR}/{file_system_name}.conf"
+            rootfs.build_image(
+                f"{bootstrap.LOCAL_SETUP_DIR}/{file_system_name}-rootfs.tar.gz",
+                config_file,
+                f"{bootstrap.LOCAL_IMAGES_DIR}/{file_system_name}.img")
+
+
+def list_devices():
+    """Returns the serials of devices attached in adb or fastboot mode"""
+    serials = set()
+    for cmd in ([flash.ADB, "devices"], [flash.FASTBOOT, "devices"]):
+        try:
+            ret = subprocess.run(cmd, capture_output=True, timeout=5)
+        except subprocess.TimeoutExpired:
+            continue
+        for line in ret.stdout.decode().splitlines():
+            fields = line.split("\t")
+            if len(fields) == 2 and fields[1] in ("device", "fastboot"):
+                serials.add(fields[0])
+    return serials
+
+
+def wait_for_boot(serial):
+    subprocess.run([flash.ADB, "-s", serial, "wait-for-device"], timeout=BOOT_TIMEOUT)
+    deadline = time.monotonic() + BOOT_TIMEOUT
+    while time.monotonic() < deadline:
+        ret = subprocess.run(
+            [flash.ADB, "-s", serial, "shell", "getprop sys.boot_completed"],
+            capture_output=True)
+        if ret.stdout.decode().strip() == "1":
+            return True
+        time.sleep(2)
+    return False
+
+
+def provision(serial, profile):
+    set_serial(serial)
+    metrics.device_started(serial)
+    current_phase = "starting"
+    try:
+        if "flash" in profile:
+            options = profile["flash"]
+            current_phase = "wait_fastboot"
+            with metrics.phase(serial, current_phase):
+                if not flash.wait_for_fastboot_device():
+                    raise RuntimeError("device did not enter fastboot")
+
+            current_phase = "flash"
+            with metrics.phase(serial, current_phase):
+                build = flash.local_build_path(options['version'])
+                if not flash.flash_flo_build(build, options.get("wipe", False)):
+                    raise RuntimeError(f"flashing {options['version']} failed")
+                flash.fastboot("reboot")
+
+        if "bootstrap" in profile:
+            options = profile["bootstrap"]
+            current_phase = "wait_boot"
+            with metrics.phase(serial, current_phase):
+                if not wait_for_boot(serial):
+                    raise RuntimeError("device did not finish booting")
+
+            current_phase = "bootstrap"
+            with metrics.phase(serial, current_phase):
+                bootstrap.prepare_device()
+                bootstrap.setup_device(
+                    options.get("file_system"),
+                    options.get("setup_ssh", False),
+                    options.get("secure_adb", False),
+                    options.get("host_image", False))
+    except (Exception, SystemExit) as e:
+        logger.error(f"Provisioning failed in {current_phase} : {e}")
+        metrics.device_finished(serial, failed_phase=current_phase)
+        return
+    logger.info("Provisioning complete.")
+    metrics.device_finished(serial)
+
+
+def watch_devices(profile, max_devices, poll_interval):
+    workers = {}
+    last_seen = {}
+    while True:
+        now = time.monotonic()
+        attached = list_devices()
+        for serial in attached:
+            last_seen[serial] = now
+
+        # forget devices unplugged for long enough, so they can be provisioned again
+        for serial in list(last_seen):
+            worker = workers.get(serial)
+            if now - last_seen[serial] > FORGET_AFTER and (worker is None or not worker.is_alive()):
+                del last_seen[serial]
+                workers.pop(serial, None)
+
+        busy = sum(1 for worker in workers.values() if worker.is_alive())
+        for serial in sorted(attached):
+            if serial in workers or busy >= max_devices:
+                continue
+            logger.info("New device found. Provisioning ...", tag=serial)
+            worker = threading.Thread(target=provision, args=(serial, profile), daemon=True)
+            workers[serial] = worker
+            worker.start()
+            busy += 1
+
+        time.sleep(poll_interval)
+
+
+@click.command(name="run")
+@click.argument("profile_file")
+@click.option('--port', '-p', default=8080, show_default=True, help='Port of the status/metrics endpoint.')
+@click.option('--max-devices', '-n', default=4, show_default=True, help='Devices provisioned at the same time.')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds between device scans.')
+def run(profile_file, port, max_devices, poll_interval):
+    """Provision every device plugged into this station.
+
+    PROFILE_FILE is a JSON file with a "flash" and/or "bootstrap" section.
+    See load_profile() for the format.
+
+    Serves GET /status (JSON) and GET /metrics (Prometheus) on --port.
+    """
+    profile = load_profile(profile_file)
+    # progress goes to the status endpoint, bars of concurrent devices would clash
+    progress.meter.display = False
+    warm_up(profile)
+
+    server = ThreadingHTTPServer(("", port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Station ready. Status on http://localhost:{port}/status")
+
+    try:
+        watch_devices(profile, max_devices, poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Shutting down station ...")
+        server.shutdown()
+    finally:
+        # shared by every device, so only closed once the station stops
+        flash.s3.close()
+
+
+@click.group()
+@click.version_option(version="", message=f"Flo OS provisioning station : {VERSION}")
+def cli():
+    """Flo OS provisioning station
+
+    Keeps the S3 client, platform tools and adb server warm and provisions
+    each newly attached device with a flash and/or bootstrap profile.
+
+    Make sure you have the AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and
+    AWS_S3_REGION_NAME env variables sourced.
+    """
+    pass
+
+
+cli.add_command(run)
+
+if __name__ == '__main__':
+    cli()
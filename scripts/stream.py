@@ -0,0 +1,304 @@
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+# Streaming from S3 to the device without a host copy
+#
+# A reader thread pulls the S3 body into a bounded queue and the calling
+# thread drains it into the device. When the device side is slower the
+# queue fills up and the reader blocks, so memory stays at QUEUE_DEPTH
+# blocks whatever the artifact size. The sha256 is computed on the way
+# through, and a tee can keep a copy in the local cache.
+
+import os
+import json
+import zlib
+import queue
+import shlex
+import hashlib
+import threading
+import contextlib
+import subprocess
+import concurrent.futures as futures
+
+import logger
+import progress
+import package
+import chunks
+import tasks
+
+READ_SIZE = 1024 * 1024
+QUEUE_DEPTH = 16
+
+_DONE = object()
+
+
+class StreamException(Exception):
+    def __init__(self, message=""):
+        self.message = message
+        super().__init__(message)
+
+
+def iter_object(s3, bucket, key, start=None, end=None, cancel=None):
+    """Yields an S3 object, or its bytes start to end, read ahead on a thread
+
+    Close the generator, e.g. with contextlib.closing, to stop the reader
+    when the caller gives up early. Raises tasks.Cancelled once cancel is
+    set, which defaults to the tasks.run step's event.
+    """
+    kwargs = {"Range": f"bytes={start}-{end - 1}"} if start is not None else {}
+    body = s3.get_object(Bucket=bucket, Key=key, **kwargs)["Body"]
+    blocks = queue.Queue(maxsize=QUEUE_DEPTH)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for data in body.iter_chunks(READ_SIZE):
+                if not put(data):
+                    return
+            put(_DONE)
+        except Exception as e:
+            put(e)
+        finally:
+            body.close()
+
+    if cancel is None:
+        cancel = tasks.cancel_event()
+    reader = threading.Thread(target=read, name=f"s3 {key}", daemon=True)
+    reader.start()
+    try:
+        while True:
+            try:
+                item = blocks.get(timeout=0.1)
+            except queue.Empty:
+                item = None
+            if cancel.is_set():
+                raise tasks.Cancelled()
+            if item is None:
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+
+def stream_object(s3, bucket, key, write, size=None, tee=None, sha256=None):
+    """Streams an S3 object into write()
+
+    Arguments:
+        write -- called with every block in order
+        size -- object size, for progress
+        tee -- file to also write the object to. It only appears once the
+               whole object arrived and matched sha256.
+        sha256 -- expected hash, None to skip the check
+
+    Returns:
+        the sha256 of what was streamed
+    """
+    digest = hashlib.sha256()
+    part = f"{tee}.part" if tee else None
+    out = open(part, "wb") if tee else None
+    try:
+        with progress.track(os.path.basename(key), size) as transfer, \
+                contextlib.closing(iter_object(s3, bucket, key)) as blocks:
+            for data in blocks:
+                digest.update(data)
+                write(data)
+                if out:
+                    out.write(data)
+                transfer.update(len(data))
+        if sha256 is not None and digest.hexdigest() != sha256:
+            raise StreamException(f"{key} does not match its sha256")
+    except BaseException:
+        if out:
+            out.close()
+            os.remove(part)
+        raise
+    if out:
+        out.close()
+        os.replace(part, tee)
+    return digest.hexdigest()
+
+
+def push_object(adb_cmd, s3, bucket, key, remote_path, tee=None):
+    """Streams an S3 object to remote_path on the device
+
+    The object is checked against its published chunk index when there is
+    one. A tee'd copy gets the index too, for later delta downloads.
+
+    Arguments:
+        adb_cmd -- the adb invocation as a list, e.g. [ADB] or [ADB, "-s", serial]
+        tee -- local file to keep a copy in, None to keep nothing on the host
+    """
+    size = s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    index = chunks.fetch_index(s3, bucket, key)
+    sha256 = index["sha256"] if index and index.get("size") == size else None
+
+    proc = subprocess.Popen(adb_cmd + ["exec-in", f"cat > {shlex.quote(remote_path)}"],
+                            stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stream_object(s3, bucket, key, proc.stdin.write, size, tee, sha256)
+    except BrokenPipeError:
+        # adb went away, its exit code and error are reported below
+        pass
+    except StreamException as e:
+        proc.stdin.close()
+        proc.wait()
+        subprocess.run(adb_cmd + ["shell", f"rm -f {shlex.quote(remote_path)}"])
+        logger.error(e.message)
+        raise SystemExit(1)
+    finally:
+        if not proc.stdin.closed:
+            proc.stdin.close()
+    error = proc.stderr.read().decode().rstrip()
+    returncode = proc.wait()
+    if returncode != 0:
+        logger.error(f"Error in streaming {key} to {remote_path} : {error}")
+        raise SystemExit(returncode)
+    if tee and index:
+        chunks.save_index(index, f"{tee}{chunks.EXTENSION}")
+
+
+def _read_range(s3, bucket, key, start, end):
+    return s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}")["Body"].read()
+
+
+def _stored_size(entry):
+    return entry["size"] if entry["compression"] == "none" else sum(entry["chunks"])
+
+
+class RemotePackage:
+    """A .flopkg on S3, read entry by entry with ranged GETs"""
+
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        head = _read_range(s3, bucket, key, 0, package.HEADER.size)
+        magic, index_length = package.HEADER.unpack(head)
+        if magic != package.MAGIC:
+            raise package.PackageException(f"{key} is not a Flo OS package")
+        index_data = _read_range(s3, bucket, key, package.HEADER.size, package.HEADER.size + index_length)
+        self.header = head + index_data
+        self.index = json.loads(index_data)
+        if self.index.get("format") != package.FORMAT_VERSION:
+            raise package.PackageException(f"Unsupported package format {self.index.get('format')}")
+        self.entries = {entry["name"]: entry for entry in self.index["entries"]}
+
+    @property
+    def version(self):
+        return self.index.get("version")
+
+    @property
+    def flash_order(self):
+        return self.index["flash_order"]
+
+    def size(self):
+        end = max(entry["offset"] + _stored_size(entry) for entry in self.entries.values())
+        return (end + package.ALIGNMENT - 1) // package.ALIGNMENT * package.ALIGNMENT
+
+    def fetch(self, name, dest, tee_fd=None, cancel=None):
+        """Writes an entry to dest, checking its sha256 on the way
+
+        Arguments:
+            tee_fd -- descriptor of a copy of the whole package to fill in, or None
+            cancel -- event that stops the download with tasks.Cancelled, see iter_object
+        """
+        entry = self.entries[name]
+        stored = _stored_size(entry)
+        chunk_lengths = list(entry.get("chunks", []))
+        pending = bytearray()
+        digest = hashlib.sha256()
+        offset = entry["offset"]
+        with open(dest, "wb") as out, progress.track(f"{name}.img", stored) as transfer, \
+                contextlib.closing(iter_object(self.s3, self.bucket, self.key, offset, offset + stored, cancel)) as blocks:
+            for data in blocks:
+                if tee_fd is not None:
+                    os.pwrite(tee_fd, data, offset)
+                offset += len(data)
+                transfer.update(len(data))
+                if entry["compression"] == "none":
+                    digest.update(data)
+                    out.write(data)
+                    continue
+                # zlib chunks are compressed on their own, inflate each once it is whole
+                pending += data
+                while chunk_lengths and len(pending) >= chunk_lengths[0]:
+                    length = chunk_lengths.pop(0)
+                    image_data = zlib.decompress(pending[:length])
+                    del pending[:length]
+                    digest.update(image_data)
+                    out.write(image_data)
+        if digest.hexdigest() != entry["sha256"]:
+            raise package.PackageException(f"Checksum mismatch for {name} in {self.key}")
+
+    def stream_images(self, work_dir, tee=None):
+        """Yields (partition, image file) in flash order, one image on disk at a time
+
+        The next image downloads while the caller flashes the current one,
+        and each is removed once the caller moves on. A caller that stops
+        early, e.g. on Ctrl+C or a failed flash, stops that download too.
+        With tee, the package is also rebuilt at that path from the
+        downloaded ranges.
+        """
+        tee_fd = None
+        if tee and not hasattr(os, "pwrite"):
+            logger.warn("Keeping a copy while streaming is not supported on this platform.")
+            tee = None
+        if tee and set(self.flash_order) != set(self.entries):
+            logger.warn(f"{self.key} has images that are not flashed, not keeping a copy.")
+            tee = None
+        if tee:
+            tee_fd = os.open(f"{tee}.part", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(tee_fd, self.size())
+            os.pwrite(tee_fd, self.header, 0)
+
+        stop = threading.Event()
+
+        def fetch(name):
+            img_file = os.path.join(work_dir, f"{name}.img")
+            self.fetch(name, img_file, tee_fd, stop)
+            return img_file
+
+        complete = False
+        try:
+            with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch") as executor:
+                try:
+                    names = list(self.flash_order)
+                    next_image = executor.submit(fetch, names[0]) if names else None
+                    for position, name in enumerate(names):
+                        img_file = next_image.result()
+                        if position + 1 < len(names):
+                            next_image = executor.submit(fetch, names[position + 1])
+                        try:
+                            yield name, img_file
+                        finally:
+                            os.remove(img_file)
+                    complete = True
+                finally:
+                    # the executor waits for the prefetch, which stops at its next block
+                    stop.set()
+        finally:
+            # after the executor, so no prefetch is still writing to the copy
+            if tee_fd is not None:
+                os.close(tee_fd)
+                if complete:
+                    os.replace(f"{tee}.part", tee)
+                else:
+                    os.remove(f"{tee}.part")
@@ -0,0 +1,139 @@
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+import time
+import threading
+import concurrent.futures as futures
+
+import logger
+from utils import get_serial, set_serial
+
+MAX_WORKERS = 8
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    """Raised in a step when its run stops on another step's failure or Ctrl+C"""
+
+
+class Task:
+    """A step that runs fn(*args) once every task named in deps has succeeded"""
+
+    def __init__(self, name, fn, deps=(), *args):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.args = args
+
+    def __repr__(self):
+        return f"Task({self.name})"
+
+
+def _check(tasks):
+    names = {task.name for task in tasks}
+    if len(names) != len(tasks):
+        raise ValueError("Task names must be unique")
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in names:
+                raise ValueError(f"{task.name} depends on unknown task {dep}")
+
+    # a graph with a cycle never gets every task ready
+    done = set()
+    pending = list(tasks)
+    while pending:
+        ready = [task for task in pending if all(dep in done for dep in task.deps)]
+        if not ready:
+            raise ValueError(f"Dependency cycle between {', '.join(task.name for task in pending)}")
+        done.update(task.name for task in ready)
+        pending = [task for task in pending if task.name not in done]
+
+
+def cancel_event():
+    """Event set once the run of the calling step is stopping
+
+    Long transfers check it, so a failure or Ctrl+C does not wait for them
+    to finish. Outside of run() it is never set.
+    """
+    cancel = getattr(_local, "cancel", None)
+    return cancel if cancel is not None else threading.Event()
+
+
+def cancellable(callback):
+    """Wraps a progress callback, e.g. boto3's Callback, to raise Cancelled once the run stops
+
+    Call it on the step's thread, the callback itself may run on any thread.
+    """
+    cancel = cancel_event()
+
+    def update(*args):
+        if cancel.is_set():
+            raise Cancelled()
+        return callback(*args)
+    return update
+
+
+def run(tasks, max_workers=MAX_WORKERS):
+    """Runs tasks on a thread pool, each as soon as its dependencies are done
+
+    On the first failure no new task is started, tasks that have not started
+    are cancelled and running ones are told to stop through cancel_event()
+    and waited for. The failure is then re-raised, so an exit() inside a
+    step still exits with its code. Ctrl+C is handled the same way.
+
+    Returns:
+        dict of task name to the value its function returned
+    """
+    _check(tasks)
+    # steps log and talk to the device of the calling thread
+    serial = get_serial()
+    phase = logger.get_phase()
+    cancel = threading.Event()
+
+    def call(task):
+        set_serial(serial)
+        logger.set_phase(phase)
+        _local.cancel = cancel
+        start = time.monotonic()
+        result = task.fn(*task.args)
+        logger.debug(f"{task.name} finished in {time.monotonic() - start:.1f}s", tag="tasks")
+        return result
+
+    results = {}
+    waiting = list(tasks)
+    running = {}
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task")
+    failure = None
+    try:
+        while waiting or running:
+            for task in [task for task in waiting if all(dep in results for dep in task.deps)]:
+                waiting.remove(task)
+                running[executor.submit(call, task)] = task
+
+            finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                try:
+                    results[task.name] = future.result()
+                except BaseException as e:
+                    logger.error(f"Step {task.name} failed", tag="tasks")
+                    failure = e
+            if failure is not None:
+                break
+    except KeyboardInterrupt as e:
+        logger.warn("Interrupted. Waiting for running steps to stop ...", tag="tasks")
+        failure = e
+
+    if failure is not None:
+        cancel.set()
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+        raise failure
+    executor.shutdown(wait=True)
+    return results
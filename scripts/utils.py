@@ -1,4 +1,20 @@
+import threading
+
 class AdbException(Exception):
     def __init__(self, error_code, message=""):
         self.error_code = error_code
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+# serial of the device the current thread is working on. When unset, adb and
+# fastboot pick the only connected device, as before.
+_device = threading.local()
+
+def set_serial(serial):
+    _device.serial = serial
+
+def get_serial():
+    return getattr(_device, "serial", None)
+
+def serial_args():
+    serial = get_serial()
+    return ["-s", serial] if serial else []
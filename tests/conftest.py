@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# the tools are flat modules in scripts/, imported the way they import each other
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+# keep test runs out of the repo's logs/
+os.environ.setdefault("FLO_LOG_DIR", tempfile.mkdtemp(prefix="flo-test-logs-"))
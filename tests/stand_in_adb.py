@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2023 FloMobility Pvt. Ltd.
+# All rights reserved.
+#
+# Confidential and Proprietary - FloMobility Pvt. Ltd.
+#
+
+# Stand-in for adb, to test fleet without devices
+#
+# Devices behave according to the start of their address:
+#
+#   ok...       commands succeed and echo what they ran
+#   fail...     commands reach the device and fail there
+#   drop...     the first command finds the connection gone, later ones succeed
+#   refused...  adb connect fails
+#   slow...     connecting and every command take SLOW_SECONDS
+#
+# Every call is appended to calls.log in STAND_IN_ADB_DIR, one line per call.
+
+import os
+import sys
+import time
+
+STATE_DIR = os.environ["STAND_IN_ADB_DIR"]
+SLOW_SECONDS = 0.6
+
+
+def record(*args):
+    with open(os.path.join(STATE_DIR, "calls.log"), "a") as f:
+        f.write(" ".join(args) + "\n")
+
+
+def connect(host):
+    if host.startswith("slow"):
+        time.sleep(SLOW_SECONDS)
+    if host.startswith("refused"):
+        print(f"failed to connect to '{host}': Connection refused")
+    else:
+        print(f"connected to {host}")
+    return 0
+
+
+def device(host, command, args):
+    if host.startswith("slow"):
+        time.sleep(SLOW_SECONDS)
+    if host.startswith("drop"):
+        marker = os.path.join(STATE_DIR, f"{host}.dropped")
+        if not os.path.exists(marker):
+            open(marker, "w").close()
+            print(f"error: device '{host}' not found", file=sys.stderr)
+            return 1
+    if host.startswith("fail"):
+        print(f"/system/bin/sh: {args[0].split()[0]}: not found", file=sys.stderr)
+        return 127
+    if command == "push":
+        print(f"{args[0]}: 1 file pushed, 0 skipped.")
+    else:
+        print(f"ran {' '.join(args)}")
+    return 0
+
+
+def main(args):
+    if args[:1] == ["-P"]:
+        args = args[2:]
+    record(*args)
+    if args[0] == "connect":
+        return connect(args[1])
+    if args[0] == "-s":
+        return device(args[1], args[2], args[3:])
+    print(f"unsupported: {' '.join(args)}", file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+import os
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+import fleet
+
+STAND_IN_ADB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stand_in_adb.py")
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+    """Lines adb was called with, read after the test ran"""
+    monkeypatch.setenv("STAND_IN_ADB_DIR", str(tmp_path))
+    log = tmp_path / "calls.log"
+    return lambda: log.read_text().splitlines() if log.exists() else []
+
+
+@pytest.fixture
+def pool(calls):
+    return fleet.AdbPool(STAND_IN_ADB, timeout=5)
+
+
+def commands(calls, host):
+    return [call for call in calls() if call.startswith(f"-s {host} ")]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="the stand-in runs through its shebang")
+class TestAdbPool:
+    def test_runs_command(self, pool, calls):
+        result = fleet.shell(pool, "ok1:5555", "getprop ro.lineage.version")
+        assert result.ok
+        assert result.output == "ran getprop ro.lineage.version"
+        assert calls() == ["connect ok1:5555", "-s ok1:5555 shell getprop ro.lineage.version"]
+
+    def test_reuses_connection(self, pool, calls):
+        fleet.shell(pool, "ok1:5555", "true")
+        fleet.shell(pool, "ok1:5555", "true")
+        assert calls().count("connect ok1:5555") == 1
+
+    def test_failed_command_is_not_retried(self, pool, calls):
+        result = fleet.shell(pool, "fail1:5555", "frob")
+        assert not result.ok
+        assert result.returncode == 127
+        assert "frob: not found" in result.output
+        assert len(commands(calls, "fail1:5555")) == 1
+
+    def test_dropped_connection_is_retried_once(self, pool, calls):
+        result = fleet.shell(pool, "drop1:5555", "true")
+        assert result.ok
+        assert calls().count("connect drop1:5555") == 2
+        assert len(commands(calls, "drop1:5555")) == 2
+
+    def test_refused_connection(self, pool, calls):
+        result = fleet.shell(pool, "refused1:5555", "true")
+        assert not result.ok
+        assert result.output.startswith("connection failed")
+        assert commands(calls, "refused1:5555") == []
+
+    def test_timeout_is_per_host(self, calls):
+        # connecting and the command each fit in the timeout, both together do not
+        pool = fleet.AdbPool(STAND_IN_ADB, timeout=1)
+        result = fleet.shell(pool, "slow1:5555", "true")
+        assert not result.ok
+        assert result.output == "timed out"
+        assert result.duration < 1.5
+
+    def test_rpc(self, pool, calls):
+        fleet.rpc(pool, "ok1:5555", "GetFloOsVersion")
+        assert "GetFloOsVersion" in commands(calls, "ok1:5555")[0]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="the stand-in runs through its shebang")
+class TestCli:
+    def run(self, *args):
+        return CliRunner().invoke(fleet.cli, [args[0], "--adb", STAND_IN_ADB] + list(args[1:]))
+
+    def test_partial_failure(self, calls):
+        result = self.run("exec", "-d", "ok1", "-d", "fail1", "-d", "drop1", "-d", "refused1", "frob")
+        assert result.exit_code == 1
+        lines = result.output.splitlines()
+        assert "[ok1:5555] ran frob" in lines
+        assert "[drop1:5555] ran frob" in lines
+        assert "[fail1:5555] /system/bin/sh: frob: not found" in lines
+        assert any(line.startswith("[refused1:5555] connection failed") for line in lines)
+        assert lines[-1].startswith("2 ok, 2 failed in ")
+
+    def test_every_result_is_printed(self, calls, tmp_path):
+        hosts = tmp_path / "hosts.txt"
+        hosts.write_text("".join(f"ok{n}\n" for n in range(200)))
+        result = self.run("exec", "-H", str(hosts), "true")
+        assert result.exit_code == 0
+        lines = result.output.splitlines()
+        assert len(lines) == 201
+        assert lines[-1].startswith("200 ok, 0 failed in ")
+
+    def test_push(self, calls, tmp_path):
+        local_file = tmp_path / "file.txt"
+        local_file.write_text("x")
+        result = self.run("push", "-d", "ok1", str(local_file), "/sdcard/")
+        assert result.exit_code == 0
+        assert f"-s ok1:5555 push {local_file} /sdcard/" in calls()